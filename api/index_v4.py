@@ -1,46 +1,28 @@
 # api/index.py
-import os, asyncio, logging, random, requests, math, urllib.parse, json, redis
+import os, asyncio, logging, random, requests, math, urllib.parse
 from fastapi import FastAPI, Request, Response
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, CallbackContext, CallbackQueryHandler
+# User state lives in the shared hash-per-user schema; legacy JSON strings are converted on read.
+from persistence import load_user_data, save_user_data
 
 # --- Setup & Constants ---
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 DEFAULT_RADIUS_KM = 1.0
 BOT_TOKEN = os.getenv("TELEGRAM_TOKEN")
+# (connect, read) seconds for every 2GIS call.
+DGIS_HTTP_TIMEOUT = (float(os.getenv("DGIS_CONNECT_TIMEOUT", "2")), float(os.getenv("DGIS_READ_TIMEOUT", "5")))
 
 app = FastAPI(docs_url=None, redoc_url=None)
 
-# --- Database (Vercel KV / Redis) ---
-try:
-    redis_client = redis.from_url(os.getenv("KV_URL"))
-except Exception as e:
-    logger.error(f"Could not connect to Redis: {e}")
-    redis_client = None
-
-def load_user_data(user_id: int) -> dict:
-    if not redis_client: return {}
-    try:
-        data = redis_client.get(f"user:{user_id}")
-        return json.loads(data) if data else {}
-    except Exception as e:
-        logger.error(f"Failed to load data for user {user_id}: {e}"); return {}
-
-def save_user_data(user_id: int, data: dict) -> None:
-    if not redis_client: return
-    try:
-        redis_client.set(f"user:{user_id}", json.dumps(data))
-    except Exception as e:
-        logger.error(f"Failed to save data for user {user_id}: {e}")
-
 # --- Helper Functions ---
 def escape_markdown_v2(text: str) -> str:
     escape_chars = r'_*[]()~`>#+-=|{}.!'; return text.translate(str.maketrans({char: f'\\{char}' for char in escape_chars}))
 def get_coordinates(address: str) -> tuple | None:
     url = "https://catalog.api.2gis.com/3.0/items/geocode"; params = {"q": address, "key": os.getenv("DGIS_API_KEY"), "fields": "items.point"}
     try:
-        response = requests.get(url, params=params); response.raise_for_status(); data = response.json()
+        response = requests.get(url, params=params, timeout=DGIS_HTTP_TIMEOUT); response.raise_for_status(); data = response.json()
         if data.get("meta", {}).get("code") == 200 and data.get("result", {}).get("items"):
             point = data["result"]["items"][0]["point"]; return point['lat'], point['lon']
     except requests.RequestException: return None
@@ -51,7 +33,7 @@ def get_random_lunch_place(lat: float, lon: float, radius_meters: int) -> dict |
         params = {'key': os.getenv("DGIS_API_KEY"), 'q': 'поесть', 'point': f'{lon},{lat}', 'radius': radius_meters, 'type': 'branch', 'fields': 'items.name,items.address_name,items.url', 'page_size': 10, 'page': page_num}
         url = "https://catalog.api.2gis.com/3.0/items";
         try:
-            response = requests.get(url, params=params); response.raise_for_status(); data = response.json()
+            response = requests.get(url, params=params, timeout=DGIS_HTTP_TIMEOUT); response.raise_for_status(); data = response.json()
             if data.get("meta", {}).get("code") == 200 and data.get("result", {}).get("items"): all_places.extend(data["result"]["items"])
             else: break
         except requests.RequestException: break
@@ -163,23 +145,61 @@ async def button_handler(update: Update, context: CallbackContext):
         await set_radius_command(query, context)
 
 # --- FastAPI Boilerplate ---
-@app.post("/api")
-async def telegram_webhook(request: Request):
-    """This function is the single entry point for all incoming Telegram updates."""
+# "warm": build and initialize the Application once per worker and reuse it.
+# "per_request": the old behaviour, a fresh Application for every update.
+BOT_LIFECYCLE = os.getenv("BOT_LIFECYCLE", "warm")
+_application: Application | None = None
+_application_lock = asyncio.Lock()
+
+def build_application() -> Application:
     application = Application.builder().token(BOT_TOKEN).build()
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("setcity", set_city_command))
     application.add_handler(CommandHandler("radius", set_radius_command))
     application.add_handler(CallbackQueryHandler(button_handler))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text))
-    
-    try:
-        async with application:
+    return application
+
+async def get_application() -> Application:
+    global _application
+    if _application is not None: return _application
+    async with _application_lock:
+        if _application is None:
+            application = build_application()
             await application.initialize()
-            data = await request.json()
+            _application = application
+    return _application
+
+async def shutdown_application() -> None:
+    global _application
+    async with _application_lock:
+        if _application is not None:
+            await _application.shutdown()
+            _application = None
+
+@app.on_event("startup")
+async def on_startup():
+    if BOT_LIFECYCLE == "warm":
+        try: await get_application()
+        except Exception as e: logger.error(f"Could not initialize application on startup: {e}", exc_info=True)
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    await shutdown_application()
+
+@app.post("/api")
+async def telegram_webhook(request: Request):
+    """This function is the single entry point for all incoming Telegram updates."""
+    try:
+        data = await request.json()
+        if BOT_LIFECYCLE == "warm":
+            application = await get_application()
             update = Update.de_json(data, application.bot)
             await application.process_update(update)
-            await application.shutdown()
+        else:
+            async with build_application() as application:
+                update = Update.de_json(data, application.bot)
+                await application.process_update(update)
     except Exception as e:
         logger.error(f"Error processing update: {e}", exc_info=True)
     return Response(status_code=200)
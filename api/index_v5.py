@@ -2,44 +2,100 @@
 import os
 import asyncio
 import logging
+import contextlib
+from typing import TYPE_CHECKING
 from fastapi import FastAPI, Request, Response
-from telegram import Update
-from telegram.ext import Application
-from bot_logic import add_handlers
+from fastapi.responses import JSONResponse, PlainTextResponse
+from persistence import close_async_redis
+import metrics
+import inline_reply
+
+# telegram, bot_logic and the clients they pull in are imported on the first update, not at
+# cold start; `/` and `/metrics` never load them. See bench/import_profile.py.
+if TYPE_CHECKING:
+    from telegram.ext import Application
+
+BOT_TOKEN = os.getenv("TELEGRAM_TOKEN")
+# Overridable so the bot can talk to a local Bot API server (or the benchmark's stand-in).
+TELEGRAM_BASE_URL = os.getenv("TELEGRAM_BASE_URL", "https://api.telegram.org/bot")
+# "warm": build and initialize the Application once per worker and reuse it.
+# "per_request": the old behaviour, a fresh Application for every update.
+BOT_LIFECYCLE = os.getenv("BOT_LIFECYCLE", "warm")
+
+# --- Application Lifecycle ---
+_application: "Application | None" = None
+_application_lock = asyncio.Lock()
+
+def build_application() -> "Application":
+    from telegram.ext import Application
+    from bot_logic import add_handlers, TimedRequest
+    application = Application.builder().token(BOT_TOKEN).base_url(TELEGRAM_BASE_URL).request(TimedRequest(connection_pool_size=256)).build()
+    add_handlers(application)
+    return application
+
+async def get_application() -> "Application":
+    """Returns the warm Application, building it lazily after a cold start."""
+    global _application
+    if _application is not None: return _application
+    async with _application_lock:
+        if _application is None:
+            application = build_application()
+            await application.initialize()
+            _application = application
+    return _application
+
+async def shutdown_application() -> None:
+    global _application
+    async with _application_lock:
+        if _application is not None:
+            await _application.shutdown()
+            _application = None
 
 # --- FastAPI Boilerplate ---
 app = FastAPI(docs_url=None, redoc_url=None)
-BOT_TOKEN = os.getenv("TELEGRAM_TOKEN")
+
+@app.on_event("startup")
+async def on_startup():
+    if BOT_LIFECYCLE == "warm":
+        try: await get_application()
+        except Exception as e: logging.error(f"Could not initialize application on startup: {e}", exc_info=True)
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    await shutdown_application()
+    await close_async_redis()
+    from http_client import close_http_clients
+    await close_http_clients()
 
 @app.post("/api")
 async def telegram_webhook(request: Request):
     """This function is the single entry point for all incoming Telegram updates."""
-    
-    # Create a new application instance for each request
-    application = Application.builder().token(BOT_TOKEN).build()
-    
-    # Add all the handlers from bot_logic.py
-    add_handlers(application)
-    
     try:
-        async with application:
-            # Initialize the application
-            await application.initialize()
-            
-            # Process the single update
-            data = await request.json()
-            update = Update.de_json(data, application.bot)
-            await application.process_update(update)
-            
-            # Shut down cleanly
-            await application.shutdown()
-            
+        from telegram import Update
+        from dispatcher import dispatch_updates
+        data = await request.json()
+        # Telegram sends one update per request; a JSON array of updates is accepted as a batch.
+        payloads = data if isinstance(data, list) else [data]
+        # The response body can carry one reply, so only a single update may use it.
+        with inline_reply.capture() if len(payloads) == 1 else contextlib.nullcontext({}) as reply:
+            if BOT_LIFECYCLE == "warm":
+                application = await get_application()
+                await dispatch_updates(application, [Update.de_json(payload, application.bot) for payload in payloads])
+            else:
+                async with build_application() as application:
+                    await dispatch_updates(application, [Update.de_json(payload, application.bot) for payload in payloads])
+        if reply.get("payload"): return JSONResponse(reply["payload"])
     except Exception as e:
         logging.error(f"Error processing update: {e}", exc_info=True)
-        
+
     return Response(status_code=200)
 
 @app.get("/")
 def health_check():
     """A simple endpoint to check if the service is alive."""
-    return {"status": "ok"}
\ No newline at end of file
+    return {"status": "ok"}
+
+@app.get("/metrics")
+def metrics_endpoint():
+    """Stage timings and counters in the Prometheus text format."""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
@@ -0,0 +1,92 @@
+# bench/fake_services.py
+"""Local stand-ins for the 2GIS catalog API and the Telegram Bot API, for benchmarking."""
+import json
+import time
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class _QuietHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, payload: dict, status: int = 200) -> None:
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json"); self.send_header("Content-Length", str(len(body)))
+        self.end_headers(); self.wfile.write(body)
+
+class FakeService:
+    """Runs a handler class on 127.0.0.1 in a background thread; the handler reads `server.config`."""
+    def __init__(self, handler_class, **config):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), handler_class)
+        self.server.daemon_threads = True
+        self.server.config = config; self.server.request_count = 0; self.server.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address
+        return f"http://{host}:{port}"
+
+    @property
+    def request_count(self) -> int:
+        return self.server.request_count
+
+    def __enter__(self) -> "FakeService":
+        self.thread.start(); return self
+
+    def __exit__(self, *exc) -> None:
+        self.server.shutdown(); self.server.server_close()
+
+# --- 2GIS ---
+class DgisHandler(_QuietHandler):
+    """Serves /3.0/items/geocode and /3.0/items with `total_places` synthetic results around the query point."""
+    def do_GET(self):
+        config = self.server.config
+        with self.server.lock: self.server.request_count += 1
+        parsed = urllib.parse.urlparse(self.path); params = {k: v[0] for k, v in urllib.parse.parse_qs(parsed.query).items()}
+        time.sleep(config.get("latency_ms", 0) / 1000)
+        if parsed.path.endswith("/items/geocode"):
+            seed = sum(params.get("q", "").encode())
+            point = {"lat": 43.2 + (seed % 100) / 10000, "lon": 76.9 + (seed % 37) / 10000}
+            return self.send_json({"meta": {"code": 200}, "result": {"total": 1, "items": [{"point": point}]}})
+        if parsed.path.endswith("/items"):
+            lon, lat = (float(value) for value in params.get("point", "76.9,43.2").split(","))
+            page, page_size = int(params.get("page", 1)), int(params.get("page_size", 10))
+            total = config.get("total_places", 100); start = (page - 1) * page_size
+            items = [{"id": f"{i}", "name": f"Кафе {i}", "address_name": f"ул. Тестовая, {i}", "url": "",
+                      "point_info": {"point": {"lat": lat + (i % 20 - 10) / 5000, "lon": lon + (i // 20 - 2) / 5000}}}
+                     for i in range(start, min(total, start + page_size))]
+            if not items: return self.send_json({"meta": {"code": 404}, "result": {}})
+            return self.send_json({"meta": {"code": 200}, "result": {"total": total, "items": items}})
+        self.send_json({"meta": {"code": 404}}, status=404)
+
+# --- Telegram Bot API ---
+class TelegramHandler(_QuietHandler):
+    """Answers /bot<token>/<method> with a minimal successful result for every method the bot uses."""
+    def do_POST(self):
+        config = self.server.config
+        with self.server.lock: self.server.request_count += 1
+        length = int(self.headers.get("Content-Length") or 0); raw = self.rfile.read(length).decode() if length else ""
+        if self.headers.get("Content-Type", "").startswith("application/json"): params = json.loads(raw or "{}")
+        else: params = {k: v[0] for k, v in urllib.parse.parse_qs(raw).items()}
+        time.sleep(config.get("latency_ms", 0) / 1000)
+        method = self.path.rsplit("/", 1)[-1]
+        if method == "getMe": result = {"id": 1, "is_bot": True, "first_name": "LunchBot", "username": "lunch_bot"}
+        elif method in ("answerCallbackQuery", "setWebhook", "deleteWebhook"): result = True
+        elif method == "getUpdates": result = []
+        else:
+            result = {"message_id": 1, "date": int(time.time()), "text": params.get("text", ""),
+                      "chat": {"id": int(params.get("chat_id", 1)), "type": "private"}}
+        self.send_json({"ok": True, "result": result})
+
+    do_GET = do_POST
+
+def fake_dgis(latency_ms: float = 0, total_places: int = 100) -> FakeService:
+    return FakeService(DgisHandler, latency_ms=latency_ms, total_places=total_places)
+
+def fake_telegram(latency_ms: float = 0) -> FakeService:
+    return FakeService(TelegramHandler, latency_ms=latency_ms)
@@ -0,0 +1,63 @@
+# bench/import_profile.py
+"""Cold-start import profile for the webhook entry point.
+
+Runs `python -X importtime` in a fresh interpreter for the import-light health path of an
+entry point (by default `api.index`, the one vercel.json deploys) and for the full bot path
+that the first update loads, prints the heaviest modules and checks the totals against a budget.
+
+    python bench/import_profile.py --budget-ms 800 --top 15
+    python bench/import_profile.py --entry api.index_v5
+"""
+import os
+import sys
+import argparse
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# What the first update of each entry point imports on top of the cold start.
+FIRST_UPDATE_IMPORTS = {
+    "api.index": "bot_logic, dispatcher, telegram.ext",
+    "api.index_v5": "bot_logic, dispatcher, telegram.ext",
+}
+
+def profile(statement: str) -> list[tuple[int, int, str]]:
+    """Returns (self_us, cumulative_us, module) for every module the statement imports."""
+    env = {key: value for key, value in os.environ.items() if not key.startswith("PYTHON")}
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", statement], cwd=ROOT, env=env, capture_output=True, text=True)
+    if result.returncode != 0: raise SystemExit(f"`{statement}` failed:\n{result.stderr[-2000:]}")
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line: continue
+        self_us, cumulative_us, module = line[len("import time:"):].split("|")
+        # Nested imports are indented under their parent; keep that to tell top-level ones apart.
+        rows.append((int(self_us), int(cumulative_us), module[1:].rstrip()))
+    return rows
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--entry", choices=sorted(FIRST_UPDATE_IMPORTS), default="api.index", help="entry point module to profile")
+    parser.add_argument("--budget-ms", type=float, default=None, help="fail if the health path imports take longer")
+    parser.add_argument("--top", type=int, default=10, help="how many of the heaviest direct imports to list")
+    args = parser.parse_args()
+
+    # What a cold start imports before it can answer `/`, and what the first update adds on top.
+    targets = {"health": f"import {args.entry}", "first_update": f"import {args.entry}, {FIRST_UPDATE_IMPORTS[args.entry]}"}
+    totals = {}
+    for name, statement in targets.items():
+        rows = profile(statement)
+        total_ms = sum(self_us for self_us, _, _ in rows) / 1000
+        totals[name] = total_ms
+        # The targets and their direct imports (indent of at most one level), heaviest first.
+        heaviest = sorted((row for row in rows if not row[2].startswith("   ")), key=lambda row: -row[1])[:args.top]
+        print(f"== {name}: {total_ms:.1f} ms across {len(rows)} modules ({statement})")
+        for _, cumulative_us, module in heaviest:
+            print(f"   {cumulative_us / 1000:8.1f} ms  {module}")
+        print()
+    loaded = {row[2].strip() for row in profile(targets["health"])}
+    leaked = sorted(module for module in ("telegram", "redis", "requests", "httpx", "bot_logic") if module in loaded)
+    if leaked: print(f"WARNING: the health path imports {', '.join(leaked)}")
+    if args.budget_ms is not None and totals["health"] > args.budget_ms:
+        raise SystemExit(f"Cold-start budget exceeded: {totals['health']:.1f} ms > {args.budget_ms:.1f} ms")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+# bench/webhook_bench.py
+"""End-to-end webhook benchmark.
+
+Starts local stand-ins for 2GIS and the Telegram Bot API, points api/index.py at them,
+drives `/api` with scripted conversations and reports latency per handler step.
+
+    python bench/webhook_bench.py --users 20 --rounds 3 --dgis-latency-ms 40 --tg-latency-ms 20
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bench.fake_services import fake_dgis, fake_telegram
+
+# One round of a user's conversation: (step name, update kind, payload).
+SCRIPT = [
+    ("start", "message", "/start"),
+    ("city", "message", "Алматы"),
+    ("address", "message", "Абая 10"),
+    ("repeat_search", "callback", "repeat_search"),
+    ("change_radius", "callback", "change_radius"),
+    ("radius", "message", "2"),
+    ("repeat_search", "callback", "repeat_search"),
+]
+
+class UpdateFactory:
+    def __init__(self):
+        self.update_id = 0
+
+    def build(self, user_id: int, kind: str, payload: str) -> dict:
+        self.update_id += 1
+        user = {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}
+        chat = {"id": user_id, "type": "private"}
+        if kind == "callback":
+            message = {"message_id": 1, "date": int(time.time()), "chat": chat, "text": "..."}
+            return {"update_id": self.update_id, "callback_query": {"id": str(self.update_id), "chat_instance": str(user_id), "from": user, "message": message, "data": payload}}
+        message = {"message_id": self.update_id, "date": int(time.time()), "chat": chat, "from": user, "text": payload}
+        if payload.startswith("/"): message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(payload)}]
+        return {"update_id": self.update_id, "message": message}
+
+def percentile(samples: list[float], q: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, max(0, round(q / 100 * len(ordered) + 0.5) - 1))]
+
+def use_fake_redis() -> None:
+    """Replaces the Redis clients everywhere they were imported with an in-process fakeredis server."""
+    import fakeredis
+    import persistence
+    server = fakeredis.FakeServer()
+    sync_client = fakeredis.FakeRedis(server=server); async_client = fakeredis.FakeAsyncRedis(server=server)
+    replacements = {id(persistence.get_redis): lambda: sync_client, id(persistence.get_async_redis): lambda: async_client}
+    for module in list(sys.modules.values()):
+        for name, value in list(getattr(module, "__dict__", {}).items()):
+            if id(value) in replacements and name in ("get_redis", "get_async_redis"): setattr(module, name, replacements[id(value)])
+
+async def run_user(client, factory: UpdateFactory, user_id: int, rounds: int, samples: dict) -> None:
+    for _ in range(rounds):
+        for step, kind, payload in SCRIPT:
+            update = factory.build(user_id, kind, payload)
+            started = time.perf_counter()
+            response = await client.post("/api", json=update)
+            samples[step].append(time.perf_counter() - started)
+            if response.status_code != 200: samples["errors"].append(0.0)
+
+async def run(args) -> dict:
+    import httpx
+    from api import index
+    # The bot modules are imported lazily; load them now so their Redis references can be swapped.
+    import bot_logic, dispatcher
+    if args.redis == "fake": use_fake_redis()
+    factory = UpdateFactory(); samples = defaultdict(list)
+    transport = httpx.ASGITransport(app=index.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        # Warm-up: builds the Application and opens connections; not measured.
+        await client.post("/api", json=factory.build(10**9, "message", "/start"))
+        started = time.perf_counter()
+        await asyncio.gather(*(run_user(client, factory, 1000 + user, args.rounds, samples) for user in range(args.users)))
+        elapsed = time.perf_counter() - started
+    await index.shutdown_application()
+    return {"elapsed": elapsed, "samples": samples}
+
+def report(result: dict, dgis_requests: int, telegram_requests: int) -> dict:
+    samples = result["samples"]; errors = len(samples.pop("errors", []))
+    total = sum(len(values) for values in samples.values())
+    summary = {"updates": total, "errors": errors, "seconds": round(result["elapsed"], 3),
+               "throughput_per_s": round(total / result["elapsed"], 1) if result["elapsed"] else 0.0,
+               "dgis_requests_per_update": round(dgis_requests / total, 2) if total else 0.0,
+               "telegram_requests_per_update": round(telegram_requests / total, 2) if total else 0.0, "steps": {}}
+    print(f"{'step':<16}{'count':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for step in dict.fromkeys(name for name, _, _ in SCRIPT if name in samples):
+        values = samples[step]
+        row = {"count": len(values), **{f"p{q}_ms": round(percentile(values, q) * 1000, 2) for q in (50, 95, 99)}, "max_ms": round(max(values) * 1000, 2)}
+        summary["steps"][step] = row
+        print(f"{step:<16}{row['count']:>7}{row['p50_ms']:>10}{row['p95_ms']:>10}{row['p99_ms']:>10}{row['max_ms']:>10}")
+    print(f"\n{total} updates in {summary['seconds']} s: {summary['throughput_per_s']} updates/s, {errors} errors")
+    print(f"2GIS requests/update: {summary['dgis_requests_per_update']}, Telegram requests/update: {summary['telegram_requests_per_update']}")
+    return summary
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=10, help="concurrent simulated users")
+    parser.add_argument("--rounds", type=int, default=3, help="conversation rounds per user")
+    parser.add_argument("--dgis-latency-ms", type=float, default=30)
+    parser.add_argument("--tg-latency-ms", type=float, default=20)
+    parser.add_argument("--places", type=int, default=100, help="results the fake 2GIS returns per search")
+    parser.add_argument("--redis", default="fake", help='"fake" for in-process fakeredis, "none" to run without Redis, or a redis:// URL')
+    parser.add_argument("--json", help="also write the summary to this file")
+    args = parser.parse_args()
+
+    with fake_dgis(args.dgis_latency_ms, args.places) as dgis, fake_telegram(args.tg_latency_ms) as telegram:
+        # Configuration is read at import time, so it has to be in place before the app is imported.
+        os.environ.update({"TELEGRAM_TOKEN": "123456:BENCH", "DGIS_API_KEY": "bench", "DGIS_BASE_URL": f"{dgis.url}/3.0", "TELEGRAM_BASE_URL": f"{telegram.url}/bot"})
+        if args.redis not in ("fake", "none"): os.environ["KV_URL"] = args.redis
+        else: os.environ.pop("KV_URL", None)
+        result = asyncio.run(run(args))
+        summary = report(result, dgis.request_count, telegram.request_count)
+    if args.json:
+        with open(args.json, "w") as f: json.dump(summary, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,15 @@
 # bot_logic.py
-import logging, os, random, requests, json, traceback, urllib, math
+import logging, os, random, json, traceback, urllib, math
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, CallbackContext, CallbackQueryHandler
+from telegram.request import HTTPXRequest
 
-from persistence import load_user_data, save_user_data
+from metrics import span
+from dgis import get_coordinates, get_random_lunch_place, get_lunch_candidates
+from place_sources import build_place_source
+from inline_reply import reply_text
+from caches import MISS
+import candidate_queue
 
 # --- Setup & Constants ---
 logger = logging.getLogger(__name__)
@@ -13,40 +19,21 @@ DEFAULT_RADIUS_KM = 1.0
 def escape_markdown_v2(text: str) -> str:
     escape_chars = r'_*[]()~`>#+-=|{}.!'; return text.translate(str.maketrans({char: f'\\{char}' for char in escape_chars}))
 
-# THIS IS A SYNCHRONOUS FUNCTION (def, not async def)
-def get_coordinates(address: str) -> tuple | None:
-    url = "https://catalog.api.2gis.com/3.0/items/geocode"; params = {"q": address, "key": os.getenv("DGIS_API_KEY"), "fields": "items.point"}
-    try:
-        response = requests.get(url, params=params); response.raise_for_status(); data = response.json()
-        if data.get("meta", {}).get("code") == 200 and data.get("result", {}).get("items"):
-            point = data["result"]["items"][0]["point"]; return point['lat'], point['lon']
-    except requests.RequestException: return None
-    return None
-
-def get_random_lunch_place(lat: float, lon: float, radius_meters: int) -> dict | None:
-    all_places = []
-    for page_num in range(1, 11):
-        params = {'key': os.getenv("DGIS_API_KEY"), 'q': 'поесть', 'point': f'{lon},{lat}', 'radius': radius_meters, 'type': 'branch', 'fields': 'items.name,items.address_name,items.url,items.point_info', 'page_size': 10, 'page': page_num}
-        url = "https://catalog.api.2gis.com/3.0/items";
-        try:
-            response = requests.get(url, params=params); response.raise_for_status(); data = response.json()
-            if data.get("meta", {}).get("code") == 200 and data.get("result", {}).get("items"): all_places.extend(data["result"]["items"])
-            else: break
-        except requests.RequestException: break
-    if all_places:
-        place_choice = random.choice(all_places)
-        point_info = place_choice.get('point_info', {}); point_coords = point_info.get('point', {})
-        return {"name": place_choice.get("name", "N/A"), "address": place_choice.get("address_name", ""), "url": place_choice.get("url", ""), "lat": point_coords.get('lat'), "lon": point_coords.get('lon')}
-    return None
+# "2gis", "local", "local_first" or "2gis_first"; see place_sources.build_place_source.
+place_source = build_place_source(os.getenv("PLACE_SOURCE", "2gis"), get_random_lunch_place, get_lunch_candidates, os.getenv("LOCAL_PLACES_PATH"))
 
 def create_result_keyboard() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup([[InlineKeyboardButton("Повторить поиск 🔁", callback_data="repeat_search"), InlineKeyboardButton("Сменить радиус 📏", callback_data="change_radius")]])
+    return InlineKeyboardMarkup([[InlineKeyboardButton("Повторить поиск 🔁", callback_data="repeat_search")],
+                                 [InlineKeyboardButton("Другой адрес 🏠", callback_data="change_address"), InlineKeyboardButton("Сменить радиус 📏", callback_data="change_radius"), InlineKeyboardButton("Сменить город 🏙️", callback_data="change_city")]])
 
 async def perform_search_and_reply(update: Update, context: CallbackContext, coords: tuple, is_new_search: bool = False):
     if update.callback_query: await update.callback_query.edit_message_text(text="_Ищу другой вариант\\.\\.\\._", parse_mode='MarkdownV2')
     radius_km = context.user_data.get('radius_km', DEFAULT_RADIUS_KM); radius_meters = int(radius_km * 1000)
     
-    place = get_random_lunch_place(coords[0], coords[1], radius_meters)
+    with span("place_search", source=place_source.name):
+        # Walk a shuffled queue of this area's candidates, so repeats don't show the same place twice.
+        place = await candidate_queue.next_place(update.effective_user.id, context.user_data, place_source, coords[0], coords[1], radius_meters) if candidate_queue.queue_enabled() else MISS
+        if place is MISS: place = await place_source.random_place(coords[0], coords[1], radius_meters)
     if not place:
         message_text = f"К сожалению, я не нашел заведений в радиусе {radius_km} км."
         if update.callback_query: await update.callback_query.edit_message_text(text=message_text)
@@ -71,51 +58,50 @@ async def perform_search_and_reply(update: Update, context: CallbackContext, coo
     else: await update.message.reply_markdown_v2(message_text, reply_markup=reply_markup)
 
 # --- Handlers ---
+# context.user_data is loaded and saved once per update by session.user_session.
+# Single-message replies go through inline_reply.reply_text so they can ride on the webhook response.
 async def start(update: Update, context: CallbackContext) -> None:
-    user_id = update.effective_user.id
-    context.user_data.clear(); context.user_data.update(load_user_data(user_id))
     current_radius = context.user_data.get('radius_km', DEFAULT_RADIUS_KM)
     
     start_message = (f"Привет, {update.effective_user.mention_html()}!\n\n"
                      f"Текущий радиус поиска: <b>{current_radius} км</b>.\n\n")
-    if 'city' in context.user_data:
+    if context.user_data.get('city') and context.user_data.get('last_address') and context.user_data.get('last_coords'):
+        start_message += (f"Ваш город: <b>{context.user_data['city']}</b>. Последний адрес: <b>{context.user_data['last_address']}</b>. "
+                          "Искать по нему? (отправьте 'да' или новый адрес)")
+        context.user_data['state'] = 'confirm_address'
+    elif 'city' in context.user_data:
         start_message += f"Ваш сохраненный город: <b>{context.user_data['city']}</b>. Просто отправьте улицу и номер дома."
         context.user_data['state'] = 'awaiting_address'
     else:
         start_message += "Для начала, пожалуйста, напишите мне свой город."
         context.user_data['state'] = 'awaiting_city'
     
-    save_user_data(user_id, context.user_data)
-    await update.message.reply_html(start_message)
+    await reply_text(update.message, start_message, parse_mode="HTML")
 
 async def set_city_command(update: Update, context: CallbackContext) -> None:
-    user_id = update.effective_user.id; context.user_data.clear(); context.user_data.update(load_user_data(user_id))
     context.user_data['state'] = 'awaiting_city'
-    save_user_data(user_id, context.user_data)
-    await update.message.reply_text("Какой новый город выберем?")
+    await reply_text(update.message, "Какой новый город выберем?")
     
+async def set_address_command(update: Update, context: CallbackContext) -> None:
+    context.user_data['state'] = 'awaiting_address'
+    city = context.user_data.get('city', 'вашем городе')
+    await reply_text(update.message, f"Какой адрес ищем в городе {city}?")
+
 async def set_radius_command(update: Update, context: CallbackContext) -> None:
-    user_id = update.effective_user.id; context.user_data.clear(); context.user_data.update(load_user_data(user_id))
     context.user_data['state'] = 'awaiting_radius'
-    save_user_data(user_id, context.user_data)
     current_radius = context.user_data.get('radius_km', DEFAULT_RADIUS_KM)
-    await update.message.reply_text(f"Текущий радиус: {current_radius} км. Введите новое значение.")
+    await reply_text(update.message, f"Текущий радиус: {current_radius} км. Введите новое значение.")
 
 async def handle_text(update: Update, context: CallbackContext) -> None:
-    user_id = update.effective_user.id
-    context.user_data.clear(); context.user_data.update(load_user_data(user_id))
-    
     state = context.user_data.get('state')
     user_text = update.message.text
     
     if state == 'awaiting_city':
-        # --- FIX IS HERE ---
-        coords = get_coordinates(user_text) # Removed await
-        if not coords: await update.message.reply_text("Не смог найти такой город. Попробуйте еще раз."); return
+        coords = await get_coordinates(user_text)
+        if not coords: await reply_text(update.message, "Не смог найти такой город. Попробуйте еще раз."); return
         context.user_data['city'] = user_text
         context.user_data['state'] = 'awaiting_address'
-        save_user_data(user_id, context.user_data)
-        await update.message.reply_text(f"Город '{user_text}' сохранен. Теперь отправьте улицу и номер дома.")
+        await reply_text(update.message, f"Город '{user_text}' сохранен. Теперь отправьте улицу и номер дома.")
         return
         
     elif state == 'awaiting_radius':
@@ -123,38 +109,50 @@ async def handle_text(update: Update, context: CallbackContext) -> None:
             new_radius = float(user_text.replace(',', '.'));
             if not (0.1 <= new_radius <= 10): raise ValueError()
             context.user_data['radius_km'] = new_radius; context.user_data.pop('state', None)
-            save_user_data(user_id, context.user_data)
-            await update.message.reply_text(f"Радиус обновлен: {new_radius} км.")
+            await reply_text(update.message, f"Радиус обновлен: {new_radius} км.")
             return
         except (ValueError, TypeError):
-            await update.message.reply_text("Неверный формат. Попробуйте еще раз."); return
+            await reply_text(update.message, "Неверный формат. Попробуйте еще раз."); return
+
+    elif state == 'confirm_address' and user_text.lower() in ('да', 'yes', 'ок') and context.user_data.get('last_coords'):
+        context.user_data.pop('state', None)
+        await perform_search_and_reply(update, context, context.user_data['last_coords'], is_new_search=True)
+        return
 
     city = context.user_data.get('city')
     if not city: await start(update, context); return
     full_address = f"{city}, {user_text}"
     await update.message.reply_text(f"Ищу заведения рядом с {full_address}...")
     
-    # --- AND FIX IS HERE ---
-    coords = get_coordinates(full_address) # Removed await
+    coords = await get_coordinates(full_address)
     if not coords: await update.message.reply_text("Не смог найти такой адрес."); return
-    context.user_data['last_coords'] = [coords[0], coords[1]]
-    save_user_data(user_id, context.user_data)
+    context.user_data['last_coords'] = [coords[0], coords[1]]; context.user_data['last_address'] = full_address
+    context.user_data.pop('state', None)
     
     await perform_search_and_reply(update, context, coords, is_new_search=True)
 
 async def button_handler(update: Update, context: CallbackContext):
     query = update.callback_query; await query.answer()
-    user_id = update.effective_user.id
-    context.user_data.clear(); context.user_data.update(load_user_data(user_id))
     
     if query.data == "repeat_search":
         coords = context.user_data.get('last_coords')
         if not coords: await query.edit_message_text("Нет сохраненных координат. Начните с /start."); return
         await perform_search_and_reply(update, context, coords)
     
+    elif query.data == "change_address":
+        await set_address_command(query, context)
+
     elif query.data == "change_radius":
         await set_radius_command(query, context)
 
+    elif query.data == "change_city":
+        await set_city_command(query, context)
+
+class TimedRequest(HTTPXRequest):
+    """Bot API transport that records every call as a "telegram" stage, labelled by method."""
+    async def do_request(self, url: str, method: str, *args, **kwargs):
+        with span("telegram", method=url.rsplit('/', 1)[-1]): return await super().do_request(url, method, *args, **kwargs)
+
 def add_handlers(application: Application):
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("setcity", set_city_command))
@@ -0,0 +1,135 @@
+# caches.py
+import os
+import re
+import json
+import math
+import asyncio
+import time
+import logging
+from collections import OrderedDict
+
+from persistence import get_async_redis, REDIS_CALL_TIMEOUT
+from metrics import inc
+
+logger = logging.getLogger(__name__)
+MISS = object()
+
+class LRUCache:
+    """A small in-process LRU with per-entry TTLs. Stored values may be None (negative entries)."""
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries; self._entries = OrderedDict()
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None: return MISS
+        value, expires_at = entry
+        if expires_at < time.monotonic(): del self._entries[key]; return MISS
+        self._entries.move_to_end(key); return value
+
+    def set(self, key, value, ttl: float) -> None:
+        self._entries[key] = (value, time.monotonic() + ttl); self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries: self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+# --- Place Cache (2GIS search pages, keyed by location tile) ---
+PLACE_CACHE_ENABLED = os.getenv("PLACE_CACHE_ENABLED", "1") == "1"
+PLACE_CACHE_TTL = int(os.getenv("PLACE_CACHE_TTL", "900"))
+PLACE_CACHE_MAX_ENTRIES = int(os.getenv("PLACE_CACHE_MAX_ENTRIES", "5000"))
+# ~220 m of latitude; searches are re-centred on the tile so neighbours share entries.
+PLACE_CACHE_TILE_DEG = float(os.getenv("PLACE_CACHE_TILE_DEG", "0.002"))
+PLACE_CACHE_RADIUS_STEP = int(os.getenv("PLACE_CACHE_RADIUS_STEP", "100"))
+PLACE_CACHE_INDEX = "places:index"
+
+def place_cache_enabled() -> bool:
+    return PLACE_CACHE_ENABLED and get_async_redis() is not None
+
+def snap_to_tile(lat: float, lon: float, radius_meters: int) -> tuple[float, float, int]:
+    """Moves a search onto its grid cell centre and rounds the radius up to the bucket step."""
+    row = math.floor(lat / PLACE_CACHE_TILE_DEG); col = math.floor(lon / PLACE_CACHE_TILE_DEG)
+    tile_lat = round((row + 0.5) * PLACE_CACHE_TILE_DEG, 6); tile_lon = round((col + 0.5) * PLACE_CACHE_TILE_DEG, 6)
+    radius_bucket = math.ceil(radius_meters / PLACE_CACHE_RADIUS_STEP) * PLACE_CACHE_RADIUS_STEP
+    return tile_lat, tile_lon, radius_bucket
+
+def place_cache_key(lat: float, lon: float, radius_meters: int, page_num: int) -> str:
+    return f"places:{lat:.6f},{lon:.6f}:{radius_meters}:{page_num}"
+
+async def get_cached_page(key: str) -> tuple[list, int | None] | None:
+    if not place_cache_enabled(): return None
+    try:
+        data = await asyncio.wait_for(get_async_redis().get(key), REDIS_CALL_TIMEOUT)
+        inc("lunchbot_cache_requests_total", cache="places", result="hit" if data else "miss")
+        if not data: return None
+        page = json.loads(data); return page["items"], page.get("total")
+    except Exception as e:
+        inc("lunchbot_redis_errors_total", op="place_cache_get")
+        logger.error(f"Failed to read place cache {key}: {e}"); return None
+
+async def set_cached_page(key: str, items: list, total: int | None) -> None:
+    if not place_cache_enabled(): return
+    client = get_async_redis()
+    try:
+        now = time.time()
+        pipe = client.pipeline()
+        pipe.set(key, json.dumps({"items": items, "total": total}), ex=PLACE_CACHE_TTL)
+        pipe.zadd(PLACE_CACHE_INDEX, {key: now})
+        pipe.zremrangebyscore(PLACE_CACHE_INDEX, "-inf", now - PLACE_CACHE_TTL)
+        pipe.zcard(PLACE_CACHE_INDEX)
+        size = (await asyncio.wait_for(pipe.execute(), REDIS_CALL_TIMEOUT))[-1]
+        if size > PLACE_CACHE_MAX_ENTRIES:
+            # Evict the oldest entries to keep the cache bounded.
+            evicted = [member for member, _ in await client.zpopmin(PLACE_CACHE_INDEX, size - PLACE_CACHE_MAX_ENTRIES)]
+            if evicted: await client.delete(*evicted)
+    except Exception as e:
+        inc("lunchbot_redis_errors_total", op="place_cache_set")
+        logger.error(f"Failed to write place cache {key}: {e}")
+
+# --- Geocode Cache (in-process LRU in front of Redis) ---
+GEOCODE_CACHE_TTL = int(os.getenv("GEOCODE_CACHE_TTL", str(7 * 24 * 3600)))
+GEOCODE_NEGATIVE_TTL = int(os.getenv("GEOCODE_NEGATIVE_TTL", "600"))
+GEOCODE_LRU_SIZE = int(os.getenv("GEOCODE_LRU_SIZE", "1024"))
+_geocode_lru = LRUCache(GEOCODE_LRU_SIZE)
+
+# Full forms collapse onto their usual abbreviation so "улица Абая" and "ул. Абая" share an entry.
+ADDRESS_ABBREVIATIONS = {
+    "улица": "ул", "проспект": "пр", "просп": "пр", "переулок": "пер", "бульвар": "бул", "площадь": "пл",
+    "шоссе": "ш", "микрорайон": "мкр", "мкрн": "мкр", "дом": "д", "корпус": "к", "корп": "к", "строение": "стр",
+    "город": "г", "street": "st", "avenue": "ave", "boulevard": "blvd", "road": "rd", "building": "bldg",
+}
+
+def normalize_address(address: str) -> str:
+    words = re.sub(r"[^\w]+", " ", address.lower().replace("ё", "е")).split()
+    return " ".join(ADDRESS_ABBREVIATIONS.get(word, word) for word in words)
+
+async def get_cached_coordinates(address: str):
+    """Returns cached (lat, lon), None for a cached miss, or MISS when nothing is cached."""
+    key = normalize_address(address)
+    value = _geocode_lru.get(key)
+    if value is not MISS:
+        inc("lunchbot_cache_requests_total", cache="geocode_lru", result="hit"); return value
+    client = get_async_redis()
+    if client is None: return MISS
+    try:
+        data = await asyncio.wait_for(client.get(f"geo:{key}"), REDIS_CALL_TIMEOUT)
+    except Exception as e:
+        inc("lunchbot_redis_errors_total", op="geocode_cache_get")
+        logger.error(f"Failed to read geocode cache for {key!r}: {e}"); return MISS
+    inc("lunchbot_cache_requests_total", cache="geocode_redis", result="miss" if data is None else "hit")
+    if data is None: return MISS
+    coords = json.loads(data)
+    value = tuple(coords) if coords else None
+    _geocode_lru.set(key, value, GEOCODE_CACHE_TTL if value else GEOCODE_NEGATIVE_TTL)
+    return value
+
+async def set_cached_coordinates(address: str, coords: tuple | None) -> None:
+    key = normalize_address(address)
+    ttl = GEOCODE_CACHE_TTL if coords else GEOCODE_NEGATIVE_TTL
+    _geocode_lru.set(key, coords, ttl)
+    client = get_async_redis()
+    if client is None: return
+    try:
+        await asyncio.wait_for(client.set(f"geo:{key}", json.dumps(list(coords) if coords else None), ex=ttl), REDIS_CALL_TIMEOUT)
+    except Exception as e:
+        inc("lunchbot_redis_errors_total", op="geocode_cache_set")
+        logger.error(f"Failed to write geocode cache for {key!r}: {e}")
@@ -0,0 +1,81 @@
+# candidate_queue.py
+import os
+import json
+import math
+import random
+import asyncio
+import logging
+
+from persistence import get_async_redis, REDIS_CALL_TIMEOUT
+from caches import MISS
+from metrics import inc
+from nearby import PLACE_DISTANCE_DECAY
+from place_sources import haversine_meters
+
+# --- Repeat-search queue ---
+# The first search for a location and radius shuffles every candidate once and stores the
+# IDs in a Redis list; each "repeat search" pops the next one, so nothing repeats until the
+# list runs out. Place details live in shared place:{id} keys.
+logger = logging.getLogger(__name__)
+REPEAT_QUEUE_ENABLED = os.getenv("REPEAT_QUEUE_ENABLED", "1") == "1"
+REPEAT_QUEUE_TTL = int(os.getenv("REPEAT_QUEUE_TTL", "1800"))
+# Popped IDs whose details expired are skipped; give up on the queue after this many.
+REPEAT_QUEUE_POP_TRIES = 3
+
+def queue_enabled() -> bool:
+    return REPEAT_QUEUE_ENABLED and get_async_redis() is not None
+
+def queue_key(user_id: int) -> str:
+    return f"queue:{user_id}"
+
+def queue_signature(lat: float, lon: float, radius_meters: int) -> str:
+    return f"{lat:.6f},{lon:.6f}:{radius_meters}"
+
+async def _pop_place(client, user_id: int) -> dict | None:
+    for _ in range(REPEAT_QUEUE_POP_TRIES):
+        place_id = await asyncio.wait_for(client.lpop(queue_key(user_id)), REDIS_CALL_TIMEOUT)
+        if place_id is None: return None
+        data = await asyncio.wait_for(client.get(f"place:{place_id.decode()}"), REDIS_CALL_TIMEOUT)
+        if data: return json.loads(data)
+    return None
+
+def shuffled_ids(candidates: list[dict], lat: float, lon: float, decay: float = PLACE_DISTANCE_DECAY) -> list[str]:
+    """Candidate IDs in random order; with a decay, nearer places tend to come first, as they would
+    be picked by NearbyIndex.random_place."""
+    if decay <= 0:
+        ids = [place["id"] for place in candidates]; random.shuffle(ids); return ids
+    # Each place comes up after an exponential wait with rate exp(-d / decay): a weighted shuffle.
+    def turn(place: dict) -> float:
+        if place.get("lat") is None or place.get("lon") is None: return random.expovariate(1e-300)
+        return random.expovariate(math.exp(-min(haversine_meters(lat, lon, place["lat"], place["lon"]) / decay, 690)))
+    return [place["id"] for place in sorted(candidates, key=turn)]
+
+async def _refill(client, user_id: int, candidates: list[dict], lat: float, lon: float) -> None:
+    ids = shuffled_ids(candidates, lat, lon)
+    pipe = client.pipeline()
+    pipe.delete(queue_key(user_id))
+    for place in candidates: pipe.set(f"place:{place['id']}", json.dumps(place, ensure_ascii=False), ex=REPEAT_QUEUE_TTL)
+    if ids: pipe.rpush(queue_key(user_id), *ids); pipe.expire(queue_key(user_id), REPEAT_QUEUE_TTL)
+    await asyncio.wait_for(pipe.execute(), REDIS_CALL_TIMEOUT)
+
+async def next_place(user_id: int, user_data: dict, source, lat: float, lon: float, radius_meters: int):
+    """Pops the user's next unseen place, refilling the queue when it runs out or the search changed.
+
+    Returns None if the area has no candidates, and MISS if Redis failed and the caller should
+    fall back to source.random_place. The queue's signature is kept in user_data["queue_sig"]."""
+    client = get_async_redis(); signature = queue_signature(lat, lon, radius_meters)
+    try:
+        if user_data.get("queue_sig") == signature:
+            place = await _pop_place(client, user_id)
+            if place:
+                inc("lunchbot_cache_requests_total", cache="repeat_queue", result="hit"); return place
+        inc("lunchbot_cache_requests_total", cache="repeat_queue", result="miss")
+        candidates = [place for place in await source.candidates(lat, lon, radius_meters) if place.get("id")]
+        if not candidates:
+            user_data.pop("queue_sig", None); return None
+        await _refill(client, user_id, candidates, lat, lon)
+        user_data["queue_sig"] = signature
+        return await _pop_place(client, user_id) or random.choice(candidates)
+    except Exception as e:
+        inc("lunchbot_redis_errors_total", op="repeat_queue")
+        logger.error(f"Repeat queue failed for user {user_id}: {e}"); return MISS
@@ -0,0 +1,214 @@
+# dgis.py
+import os
+import math
+import random
+import asyncio
+import logging
+import httpx
+
+from metrics import span, inc
+from nearby import NEARBY_RADIUS, NearbyIndex, nearby_tile, get_cached_index, set_cached_index
+from resilience import CircuitBreaker, CircuitOpen, deadline, remaining, hedged
+from quota import acquire, budget_low, single_flight, QuotaExceeded, DGIS_QUOTA_LOW_PAGES
+from http_client import get_async_http_client
+from caches import MISS, normalize_address, get_cached_coordinates, set_cached_coordinates, place_cache_enabled, snap_to_tile, place_cache_key, get_cached_page, set_cached_page
+
+# --- Async 2GIS catalog client ---
+logger = logging.getLogger(__name__)
+DGIS_BASE_URL = os.getenv("DGIS_BASE_URL", "https://catalog.api.2gis.com/3.0")
+PAGE_SIZE = 10
+MAX_PAGES = 10
+# "concurrent": read the total from page 1, then fetch the rest in parallel. "sequential": page by page.
+DGIS_FETCH_MODE = os.getenv("DGIS_FETCH_MODE", "concurrent")
+DGIS_MAX_CONCURRENCY = max(1, int(os.getenv("DGIS_MAX_CONCURRENCY", "5")))
+# "nearby": fetch the nearest places once per location at DGIS_NEARBY_RADIUS and filter every radius locally.
+# "single_page": pick a random index from result.total and fetch only its page. "full_scan": download every page.
+DGIS_SAMPLING = os.getenv("DGIS_SAMPLING", "nearby")
+# Per-request connect and read timeouts, and a deadline for a whole geocode or search: when it
+# passes, outstanding calls are cut off and the search goes on with the pages it has.
+DGIS_CONNECT_TIMEOUT = float(os.getenv("DGIS_CONNECT_TIMEOUT", "2"))
+DGIS_READ_TIMEOUT = float(os.getenv("DGIS_READ_TIMEOUT", os.getenv("DGIS_TIMEOUT", "5")))
+DGIS_SEARCH_TIMEOUT = float(os.getenv("DGIS_SEARCH_TIMEOUT", "15"))
+# After this many failures in a row, skip 2GIS for DGIS_BREAKER_COOLDOWN seconds (0 disables).
+DGIS_BREAKER_FAILURES = int(os.getenv("DGIS_BREAKER_FAILURES", "5"))
+DGIS_BREAKER_COOLDOWN = float(os.getenv("DGIS_BREAKER_COOLDOWN", "30"))
+# Send a second geocode request if the first is slower than this many seconds (0 disables).
+DGIS_HEDGE_DELAY = float(os.getenv("DGIS_HEDGE_DELAY", "0"))
+
+breaker = CircuitBreaker("dgis", DGIS_BREAKER_FAILURES, DGIS_BREAKER_COOLDOWN)
+
+async def _get_json(path: str, params: dict, stage: str) -> dict:
+    # Don't spend a shared quota token on a call that would time out straight away.
+    if remaining(DGIS_CONNECT_TIMEOUT + DGIS_READ_TIMEOUT) <= 0:
+        inc("lunchbot_dgis_requests_total", stage=stage, outcome="deadline"); raise asyncio.TimeoutError("search deadline passed")
+    try:
+        breaker.before_call()
+    except CircuitOpen:
+        inc("lunchbot_dgis_requests_total", stage=stage, outcome="circuit_open"); raise
+    outcome = None; budget = 0.0
+    # Everything after before_call() runs inside the try, so a half-open probe is always settled.
+    try:
+        await acquire()
+        budget = remaining(DGIS_CONNECT_TIMEOUT + DGIS_READ_TIMEOUT)
+        timeout = httpx.Timeout(min(DGIS_READ_TIMEOUT, budget), connect=min(DGIS_CONNECT_TIMEOUT, budget))
+        with span(stage):
+            response = await asyncio.wait_for(get_async_http_client().get(f"{DGIS_BASE_URL}{path}", params=params, timeout=timeout), budget)
+        if response.status_code == 429 or response.status_code >= 500: outcome = "http_error"
+        response.raise_for_status(); data = response.json()
+        outcome = "ok"; return data
+    except (httpx.TimeoutException, asyncio.TimeoutError):
+        # Only a call that had its full time counts against 2GIS; one cut short by our deadline doesn't.
+        outcome = "timeout" if budget >= DGIS_CONNECT_TIMEOUT + DGIS_READ_TIMEOUT else "deadline"; raise
+    except httpx.TransportError:
+        outcome = "error"; raise
+    except ValueError:
+        outcome = "bad_response"; raise
+    except httpx.HTTPStatusError:
+        outcome = outcome or "client_error"; raise
+    except QuotaExceeded:
+        outcome = "quota"; raise
+    finally:
+        if outcome is not None: inc("lunchbot_dgis_requests_total", stage=stage, outcome=outcome)
+        if outcome in ("ok", "client_error"): breaker.record_success()
+        elif outcome in ("timeout", "error", "bad_response", "http_error"): breaker.record_failure()
+        else: breaker.record_abandoned()
+
+async def get_coordinates(address: str) -> tuple | None:
+    """Geocodes an address to (lat, lon), or None if 2GIS doesn't know it or can't be reached."""
+    cached = await get_cached_coordinates(address)
+    if cached is not MISS: return cached
+    with deadline(DGIS_SEARCH_TIMEOUT):
+        return await single_flight(f"geo:{normalize_address(address)}", lambda: _geocode(address), lambda: get_cached_coordinates(address))
+
+async def _geocode(address: str) -> tuple | None:
+    params = {"q": address, "key": os.getenv("DGIS_API_KEY"), "fields": "items.point"}
+    try:
+        data = await hedged(lambda: _get_json("/items/geocode", params, "geocode"), DGIS_HEDGE_DELAY, "geocode")
+        if data.get("meta", {}).get("code") == 200 and data.get("result", {}).get("items"):
+            point = data["result"]["items"][0]["point"]; coords = point['lat'], point['lon']
+            await set_cached_coordinates(address, coords); return coords
+    except (httpx.HTTPError, ValueError, asyncio.TimeoutError, QuotaExceeded, CircuitOpen): return None
+    # Only a definite "not found" is cached; transport errors are retried next time.
+    await set_cached_coordinates(address, None)
+    return None
+
+async def fetch_places_page(lat: float, lon: float, radius_meters: int, page_num: int, sort: str | None = None) -> tuple[list, int | None]:
+    """Fetches one page of 2GIS search results. Returns (items, total); ([], None) on failure."""
+    cache_key = place_cache_key(lat, lon, radius_meters, page_num) + (f":{sort}" if sort else "")
+    cached = await get_cached_page(cache_key)
+    if cached: return cached
+    async def peek():
+        return await get_cached_page(cache_key) or MISS
+    return await single_flight(cache_key, lambda: _fetch_page(cache_key, lat, lon, radius_meters, page_num, sort), peek if place_cache_enabled() else None)
+
+async def _fetch_page(cache_key: str, lat: float, lon: float, radius_meters: int, page_num: int, sort: str | None) -> tuple[list, int | None]:
+    params = {'key': os.getenv("DGIS_API_KEY"), 'q': 'поесть', 'point': f'{lon},{lat}', 'radius': radius_meters, 'type': 'branch', 'fields': 'items.name,items.address_name,items.url,items.point_info', 'page_size': PAGE_SIZE, 'page': page_num}
+    if sort: params['sort'] = sort
+    try:
+        data = await _get_json("/items", params, "dgis_page")
+        inc("lunchbot_dgis_pages_fetched_total")
+        if data.get("meta", {}).get("code") == 200 and data.get("result", {}).get("items"):
+            items, total = data["result"]["items"], data["result"].get("total")
+            await set_cached_page(cache_key, items, total); return items, total
+    except QuotaExceeded as e: logger.warning(f"Skipping 2GIS page {page_num} at {lat},{lon}: {e}")
+    except (httpx.HTTPError, ValueError, asyncio.TimeoutError, CircuitOpen): pass
+    return [], None
+
+async def fetch_all_places(lat: float, lon: float, radius_meters: int, first: tuple[list, int | None] | None = None, sort: str | None = None) -> list:
+    """Collects up to MAX_PAGES pages of candidates, in page order. `first` reuses an already fetched page 1."""
+    first_page, total = first or await fetch_places_page(lat, lon, radius_meters, 1, sort)
+    if not first_page: return []
+    # Leave the shared 2GIS budget to other searches when it runs low.
+    max_pages = DGIS_QUOTA_LOW_PAGES if budget_low() else MAX_PAGES
+    if DGIS_FETCH_MODE != "concurrent" or not total:
+        # Sequential walk: stop at the first empty or failed page.
+        all_places = list(first_page)
+        for page_num in range(2, max_pages + 1):
+            items, _ = await fetch_places_page(lat, lon, radius_meters, page_num, sort)
+            if not items: break
+            all_places.extend(items)
+        return all_places
+    page_count = min(max_pages, math.ceil(total / PAGE_SIZE))
+    semaphore = asyncio.Semaphore(DGIS_MAX_CONCURRENCY)
+    async def fetch(page_num: int) -> list:
+        async with semaphore: return (await fetch_places_page(lat, lon, radius_meters, page_num, sort))[0]
+    pages = await asyncio.gather(*(fetch(page_num) for page_num in range(2, page_count + 1)))
+    # Pages that failed or missed the search deadline come back empty; use the ones that arrived.
+    return list(first_page) + [item for items in pages for item in items]
+
+async def sample_place(lat: float, lon: float, radius_meters: int) -> dict | None:
+    """Picks a uniformly random candidate while fetching only the page that holds it."""
+    first = await fetch_places_page(lat, lon, radius_meters, 1)
+    first_page, total = first
+    if not first_page: return None
+    if not total:
+        # No total to index into: fall back to the full scan.
+        return random.choice(await fetch_all_places(lat, lon, radius_meters, first=first))
+    index = random.randrange(min(total, PAGE_SIZE * MAX_PAGES))
+    page_num, offset = divmod(index, PAGE_SIZE)
+    items = first_page if page_num == 0 else (await fetch_places_page(lat, lon, radius_meters, page_num + 1))[0]
+    if offset < len(items): return items[offset]
+    # The total was stale or the page failed; settle for what we have.
+    return random.choice(items or first_page)
+
+def format_place(place: dict) -> dict:
+    point_info = place.get('point_info', {}); point_coords = point_info.get('point', {})
+    return {"id": place.get("id"), "name": place.get("name", "N/A"), "address": place.get("address_name", ""), "url": place.get("url", ""), "lat": point_coords.get('lat'), "lon": point_coords.get('lon')}
+
+async def get_nearby_index(lat: float, lon: float) -> NearbyIndex | None:
+    """The nearby index for the location's tile, fetched from 2GIS on first use. None if 2GIS failed."""
+    tile_lat, tile_lon, key = nearby_tile(lat, lon)
+    index = await get_cached_index(key)
+    if index is not MISS: return index
+    async def build() -> NearbyIndex | None:
+        first = await fetch_places_page(tile_lat, tile_lon, NEARBY_RADIUS, 1, "distance")
+        if not first[0]: return None
+        if first[1] and first[1] > PAGE_SIZE * MAX_PAGES:
+            # Dense area: even every page would reach only a fraction of the usual radii, so keep
+            # just page 1 and let searches past its reach go to 2GIS directly.
+            places = [format_place(place) for place in first[0]]
+            index = NearbyIndex([place for place in places if place["lat"] is not None and place["lon"] is not None], False, (tile_lat, tile_lon))
+            await set_cached_index(key, index); return index
+        places = [format_place(place) for place in await fetch_all_places(tile_lat, tile_lon, NEARBY_RADIUS, first=first, sort="distance")]
+        index = NearbyIndex([place for place in places if place["lat"] is not None and place["lon"] is not None], bool(first[1]) and len(places) >= first[1], (tile_lat, tile_lon))
+        # Pages that failed, missed the deadline or were skipped on a low budget leave gaps. Don't
+        # cache such an index; the pages that arrived are cached, so the next search fetches only the rest.
+        if len(places) < min(first[1] or 0, PAGE_SIZE * MAX_PAGES):
+            logger.warning(f"Nearby index {key} has {len(places)} of {first[1]} places; not caching it"); return index
+        await set_cached_index(key, index); return index
+    return await single_flight(key, build, lambda: get_cached_index(key))
+
+async def _covering_index(lat: float, lon: float, radius_meters: int):
+    """The nearby index if it holds every place within the radius; None if 2GIS failed; MISS when
+    the search should go to 2GIS directly (radius too large, or a dense area the index only partly covers)."""
+    if DGIS_SAMPLING != "nearby" or radius_meters > NEARBY_RADIUS: return MISS
+    index = await get_nearby_index(lat, lon)
+    if index is None or index.covers(lat, lon, radius_meters): return index
+    inc("lunchbot_nearby_fallback_total"); return MISS
+
+async def _random_lunch_place(lat: float, lon: float, radius_meters: int) -> dict | None:
+    index = await _covering_index(lat, lon, radius_meters)
+    if index is not MISS: return index.random_place(lat, lon, radius_meters) if index is not None else None
+    # Searches from the same tile and radius bucket share cached pages.
+    if place_cache_enabled(): lat, lon, radius_meters = snap_to_tile(lat, lon, radius_meters)
+    if DGIS_SAMPLING == "single_page":
+        place_choice = await sample_place(lat, lon, radius_meters)
+        return format_place(place_choice) if place_choice else None
+    all_places = await fetch_all_places(lat, lon, radius_meters)
+    if all_places: return format_place(random.choice(all_places))
+    return None
+
+async def _lunch_candidates(lat: float, lon: float, radius_meters: int) -> list[dict]:
+    index = await _covering_index(lat, lon, radius_meters)
+    if index is not MISS:
+        return [place for place in index.candidates(lat, lon, radius_meters) if place.get("id")] if index is not None else []
+    if place_cache_enabled(): lat, lon, radius_meters = snap_to_tile(lat, lon, radius_meters)
+    return [format_place(place) for place in await fetch_all_places(lat, lon, radius_meters) if place.get("id")]
+
+async def get_lunch_candidates(lat: float, lon: float, radius_meters: int) -> list[dict]:
+    """Every candidate a search would choose from (up to MAX_PAGES pages), formatted like get_random_lunch_place."""
+    with deadline(DGIS_SEARCH_TIMEOUT): return await _lunch_candidates(lat, lon, radius_meters)
+
+async def get_random_lunch_place(lat: float, lon: float, radius_meters: int) -> dict | None:
+    """A random place to eat within radius_meters, or None. Settles for the pages fetched within DGIS_SEARCH_TIMEOUT."""
+    with deadline(DGIS_SEARCH_TIMEOUT): return await _random_lunch_place(lat, lon, radius_meters)
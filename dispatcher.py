@@ -0,0 +1,141 @@
+# dispatcher.py
+import os
+import asyncio
+import logging
+import weakref
+from collections import OrderedDict, defaultdict
+from contextlib import asynccontextmanager, nullcontext
+from telegram import Update
+from telegram.ext import Application
+
+from persistence import get_async_redis, REDIS_CALL_TIMEOUT
+from session import user_session
+from metrics import update_timings, inc
+
+logger = logging.getLogger(__name__)
+
+# "local": per-user asyncio locks in this worker. "redis": additionally hold a short Redis lock,
+# so two workers never run the same user's updates at once.
+USER_LOCK_MODE = os.getenv("USER_LOCK_MODE", "local")
+USER_LOCK_TTL = float(os.getenv("USER_LOCK_TTL", "30"))
+USER_LOCK_WAIT = float(os.getenv("USER_LOCK_WAIT", "10"))
+DISPATCH_MAX_CONCURRENCY = int(os.getenv("DISPATCH_MAX_CONCURRENCY", "32"))
+# Telegram redelivers an update when the webhook is slow to answer. Each update_id is claimed
+# once, in this process and with SET NX in Redis, and redeliveries are dropped unprocessed.
+# The claim lasts UPDATE_CLAIM_TTL while the update is processed and UPDATE_DEDUP_TTL once it
+# is done; a failed attempt releases it, and a killed one lets it lapse, so a redelivery retries.
+UPDATE_CLAIM_TTL = int(os.getenv("UPDATE_CLAIM_TTL", "30"))
+UPDATE_DEDUP_TTL = int(os.getenv("UPDATE_DEDUP_TTL", "900"))
+UPDATE_DEDUP_RECENT = int(os.getenv("UPDATE_DEDUP_RECENT", "10000"))
+
+# Metric labels for updates; anything else a user types or sends is counted as "other".
+UPDATE_KIND_COMMANDS = ("/start", "/setcity", "/radius")
+UPDATE_KIND_CALLBACKS = ("repeat_search", "change_radius", "change_address", "change_city")
+
+_user_locks: "weakref.WeakValueDictionary[int, asyncio.Lock]" = weakref.WeakValueDictionary()
+_recent_update_ids: "OrderedDict[int, None]" = OrderedDict()
+
+def _local_lock(user_id: int) -> asyncio.Lock:
+    lock = _user_locks.get(user_id)
+    if lock is None:
+        lock = asyncio.Lock(); _user_locks[user_id] = lock
+    return lock
+
+@asynccontextmanager
+async def user_lock(user_id: int):
+    """Serializes updates of one user: always in-process, and across workers in "redis" mode."""
+    async with _local_lock(user_id):
+        client = get_async_redis() if USER_LOCK_MODE == "redis" else None
+        if client is None:
+            yield; return
+        lock = client.lock(f"lock:user:{user_id}", timeout=USER_LOCK_TTL, blocking_timeout=USER_LOCK_WAIT)
+        try:
+            acquired = await lock.acquire()
+        except Exception as e:
+            logger.error(f"Could not take Redis lock for user {user_id}: {e}"); acquired = False
+        if not acquired: logger.warning(f"Processing update for user {user_id} without the Redis lock")
+        try:
+            yield
+        finally:
+            if acquired:
+                try: await lock.release()
+                except Exception as e: logger.error(f"Could not release Redis lock for user {user_id}: {e}")
+
+async def claim_updates(updates: list[Update]) -> list[Update]:
+    """Returns the updates seen for the first time and marks them as seen."""
+    fresh = []
+    for update in updates:
+        if update.update_id in _recent_update_ids: continue
+        # Mark before awaiting Redis, so a concurrent redelivery to this process is caught here.
+        _recent_update_ids[update.update_id] = None; fresh.append(update)
+    while len(_recent_update_ids) > UPDATE_DEDUP_RECENT: _recent_update_ids.popitem(last=False)
+    client = get_async_redis()
+    if client is not None and fresh:
+        try:
+            pipe = client.pipeline(transaction=False)
+            for update in fresh: pipe.set(f"update:{update.update_id}", "processing", nx=True, ex=UPDATE_CLAIM_TTL)
+            claimed = await asyncio.wait_for(pipe.execute(), REDIS_CALL_TIMEOUT)
+            fresh = [update for update, ok in zip(fresh, claimed) if ok]
+        except Exception as e:
+            # Better to risk a duplicate reply than to drop updates.
+            logger.error(f"Could not claim updates in Redis: {e}")
+    if len(fresh) < len(updates): inc("lunchbot_duplicate_updates_total", len(updates) - len(fresh))
+    return fresh
+
+async def finish_update(update: Update, done: bool) -> None:
+    """Keeps a claimed update marked for UPDATE_DEDUP_TTL, or releases the claim after a failure."""
+    if not done: _recent_update_ids.pop(update.update_id, None)
+    client = get_async_redis()
+    if client is None: return
+    key = f"update:{update.update_id}"
+    try:
+        await asyncio.wait_for(client.set(key, "done", ex=UPDATE_DEDUP_TTL) if done else client.delete(key), REDIS_CALL_TIMEOUT)
+    except Exception as e:
+        logger.error(f"Could not {'confirm' if done else 'release'} update {update.update_id}: {e}")
+
+def update_kind(update: Update) -> str:
+    """A label for the handler an update will reach: the command, the callback data or "text".
+    Only the bot's own commands and buttons get their own label, so users can't mint new series."""
+    if update.callback_query:
+        data = update.callback_query.data
+        return f"callback:{data if data in UPDATE_KIND_CALLBACKS else 'other'}"
+    text = update.message.text if update.message else None
+    if text and text.startswith("/"):
+        command = text.split()[0].split("@")[0].lower()
+        return command if command in UPDATE_KIND_COMMANDS else "command:other"
+    return "text" if text else "other"
+
+@asynccontextmanager
+async def update_scope(application: Application, update: Update, locked: bool = False):
+    """Wraps one update in its timings, the user's lock and the user's session.
+    locked=True when the caller already holds the user's lock."""
+    with update_timings(update.update_id, update_kind(update)):
+        user = update.effective_user
+        if user is None:
+            yield; return
+        async with nullcontext() if locked else user_lock(user.id):
+            async with user_session(application, update): yield
+
+async def process_user_updates(application: Application, updates: list[Update]) -> None:
+    """Processes one user's updates in update_id order, each in its own session."""
+    for update in sorted(updates, key=lambda update: update.update_id):
+        try:
+            async with update_scope(application, update):
+                await application.process_update(update)
+        except Exception as e:
+            logger.error(f"Error processing update {update.update_id}: {e}", exc_info=True)
+            await finish_update(update, done=False)
+        else:
+            await finish_update(update, done=True)
+
+async def dispatch_updates(application: Application, updates: list[Update]) -> None:
+    """Runs different users concurrently while keeping each user's updates strictly ordered."""
+    updates = await claim_updates(updates)
+    groups = defaultdict(list)
+    for update in updates:
+        user = update.effective_user
+        groups[user.id if user else ("update", update.update_id)].append(update)
+    semaphore = asyncio.Semaphore(DISPATCH_MAX_CONCURRENCY)
+    async def run(group: list[Update]) -> None:
+        async with semaphore: await process_user_updates(application, group)
+    await asyncio.gather(*(run(group) for group in groups.values()))
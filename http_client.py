@@ -0,0 +1,41 @@
+# http_client.py
+import os
+import asyncio
+import logging
+import httpx
+
+logger = logging.getLogger(__name__)
+
+# One pooled keep-alive client per event loop, shared by every 2GIS call, so a search reuses
+# open TCP+TLS connections instead of handshaking for each page. Every call passes its own timeout.
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "20"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "30"))
+# HTTP/2 needs the optional `h2` package (pip install httpx[http2]).
+HTTP2_ENABLED = os.getenv("HTTP2_ENABLED", "0") == "1"
+
+_async_client: httpx.AsyncClient | None = None
+_async_client_loop: asyncio.AbstractEventLoop | None = None
+
+def _client_options() -> dict:
+    http2 = HTTP2_ENABLED
+    if http2:
+        try:
+            import h2  # noqa: F401
+        except ImportError:
+            logger.warning("HTTP2_ENABLED is set but the h2 package is missing; using HTTP/1.1"); http2 = False
+    limits = httpx.Limits(max_connections=HTTP_POOL_SIZE, max_keepalive_connections=HTTP_POOL_SIZE, keepalive_expiry=HTTP_KEEPALIVE_EXPIRY)
+    return {"limits": limits, "http2": http2}
+
+def get_async_http_client() -> httpx.AsyncClient:
+    """Returns the shared async client for the running event loop."""
+    global _async_client, _async_client_loop
+    loop = asyncio.get_running_loop()
+    # Like the Redis pool, async connections belong to the loop that opened them.
+    if _async_client is None or _async_client_loop is not loop:
+        _async_client = httpx.AsyncClient(**_client_options()); _async_client_loop = loop
+    return _async_client
+
+async def close_http_clients() -> None:
+    global _async_client, _async_client_loop
+    if _async_client is not None:
+        await _async_client.aclose(); _async_client = None; _async_client_loop = None
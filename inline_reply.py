@@ -0,0 +1,36 @@
+# inline_reply.py
+import os
+import contextvars
+from contextlib import contextmanager
+
+from metrics import inc
+
+# Telegram accepts one Bot API call in the body of the webhook response. A handler whose
+# only outgoing message is its final reply can hand it back that way and skip a round-trip.
+INLINE_REPLIES = os.getenv("INLINE_REPLIES", "1") == "1"
+
+_holder: contextvars.ContextVar[dict | None] = contextvars.ContextVar("inline_reply", default=None)
+
+@contextmanager
+def capture():
+    """Lets handlers run inside the block defer one reply; the payload ends up in holder["payload"]."""
+    holder = {} if INLINE_REPLIES else None
+    token = _holder.set(holder)
+    try:
+        yield holder if holder is not None else {}
+    finally:
+        _holder.reset(token)
+
+def defer(method: str, **params) -> bool:
+    """Stores a Bot API call for the webhook response. Returns False if the caller must send it itself."""
+    holder = _holder.get()
+    if holder is None or "payload" in holder: return False
+    holder["payload"] = {"method": method, **{key: value for key, value in params.items() if value is not None}}
+    inc("lunchbot_inline_replies_total", method=method)
+    return True
+
+async def reply_text(message, text: str, parse_mode: str | None = None, reply_markup=None) -> None:
+    """Replies in the message's chat. Only use it for a handler's last message: it may be delivered after the handler returns."""
+    markup = reply_markup.to_dict() if reply_markup is not None else None
+    if defer("sendMessage", chat_id=message.chat_id, text=text, parse_mode=parse_mode, reply_markup=markup): return
+    await message.reply_text(text, parse_mode=parse_mode, reply_markup=reply_markup)
@@ -0,0 +1,106 @@
+# metrics.py
+import os
+import json
+import time
+import logging
+import threading
+import contextvars
+from collections import defaultdict
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Log one JSON line with the stage timings of every update.
+METRICS_LOG_UPDATES = os.getenv("METRICS_LOG_UPDATES", "0") == "1"
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+HELP = {
+    "lunchbot_stage_duration_seconds": "Time spent in each processing stage.",
+    "lunchbot_dgis_pages_fetched_total": "2GIS search result pages fetched from the API.",
+    "lunchbot_cache_requests_total": "Cache lookups by cache and result.",
+    "lunchbot_redis_errors_total": "Failed Redis operations.",
+    "lunchbot_updates_total": "Processed Telegram updates.",
+    "lunchbot_dgis_requests_total": "2GIS calls by stage and outcome.",
+    "lunchbot_circuit_transitions_total": "Circuit breaker state changes.",
+    "lunchbot_circuit_rejected_total": "Calls refused while a circuit was open.",
+    "lunchbot_hedged_requests_total": "Hedged second requests sent, and which request won.",
+    "lunchbot_duplicate_updates_total": "Redelivered updates dropped without processing.",
+    "lunchbot_quota_denied_total": "2GIS calls refused by the shared rate limit.",
+    "lunchbot_single_flight_total": "Coalesced upstream calls by role (leader, follower, remote_follower).",
+    "lunchbot_nearby_fallback_total": "Searches sent to 2GIS directly because the nearby index did not cover the radius.",
+}
+
+_lock = threading.Lock()
+_counters = defaultdict(float)
+_histograms = {}
+_update_timings: contextvars.ContextVar[dict | None] = contextvars.ContextVar("update_timings", default=None)
+
+def _labels_key(labels: dict) -> tuple:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+def inc(name: str, amount: float = 1, **labels) -> None:
+    with _lock: _counters[(name, _labels_key(labels))] += amount
+
+def observe(name: str, value: float, **labels) -> None:
+    key = (name, _labels_key(labels))
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None: histogram = _histograms[key] = {"buckets": [0] * len(STAGE_BUCKETS), "sum": 0.0, "count": 0}
+        for i, bound in enumerate(STAGE_BUCKETS):
+            if value <= bound: histogram["buckets"][i] += 1
+        histogram["sum"] += value; histogram["count"] += 1
+
+def value(name: str, **labels) -> float:
+    """The current value of a counter."""
+    with _lock: return _counters.get((name, _labels_key(labels)), 0.0)
+
+def total(name: str) -> float:
+    """A counter summed over all its label values."""
+    with _lock: return sum(count for (counter, _), count in _counters.items() if counter == name)
+
+@contextmanager
+def span(stage: str, **labels):
+    """Times a block into lunchbot_stage_duration_seconds and the current update's timing log."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        observe("lunchbot_stage_duration_seconds", elapsed, stage=stage, **labels)
+        timings = _update_timings.get()
+        if timings is not None: timings[stage] = round(timings.get(stage, 0.0) + elapsed * 1000, 2)
+
+@contextmanager
+def update_timings(update_id: int, kind: str):
+    """Collects the spans of one update and, if enabled, logs them as a single JSON line."""
+    timings = {}; token = _update_timings.set(timings)
+    try:
+        with span("update", kind=kind): yield
+    finally:
+        _update_timings.reset(token)
+        inc("lunchbot_updates_total", kind=kind)
+        if METRICS_LOG_UPDATES: logger.info(json.dumps({"update_id": update_id, "kind": kind, "timings_ms": timings}))
+
+def _format_labels(labels: tuple, extra: tuple = ()) -> str:
+    pairs = labels + extra
+    if not pairs: return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in pairs) + "}"
+
+def render() -> str:
+    """Renders every metric in the Prometheus text exposition format."""
+    with _lock:
+        counters = dict(_counters); histograms = {key: {"buckets": list(h["buckets"]), "sum": h["sum"], "count": h["count"]} for key, h in _histograms.items()}
+    lines = []; seen = set()
+    def header(name: str, kind: str) -> None:
+        if name in seen: return
+        seen.add(name); lines.append(f"# HELP {name} {HELP.get(name, name)}"); lines.append(f"# TYPE {name} {kind}")
+    for (name, labels), value in sorted(counters.items()):
+        header(name, "counter"); lines.append(f"{name}{_format_labels(labels)} {value:g}")
+    for (name, labels), histogram in sorted(histograms.items()):
+        header(name, "histogram")
+        for bound, count in zip(STAGE_BUCKETS, histogram["buckets"]):
+            lines.append(f"{name}_bucket{_format_labels(labels, (('le', f'{bound:g}'),))} {count}")
+        lines.append(f"{name}_bucket{_format_labels(labels, (('le', '+Inf'),))} {histogram['count']}")
+        lines.append(f"{name}_sum{_format_labels(labels)} {histogram['sum']:.6f}")
+        lines.append(f"{name}_count{_format_labels(labels)} {histogram['count']}")
+    return "\n".join(lines) + "\n"
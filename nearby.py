@@ -0,0 +1,125 @@
+# nearby.py
+import os
+import json
+import math
+import random
+import asyncio
+import logging
+
+from persistence import get_async_redis, REDIS_CALL_TIMEOUT
+from caches import LRUCache, MISS, PLACE_CACHE_TTL, snap_to_tile
+from place_sources import haversine_meters
+from metrics import inc
+
+# --- Nearby Index ---
+# Candidates around a location tile, fetched once at NEARBY_RADIUS sorted by distance and kept
+# as coordinate arrays. Any smaller radius is answered by filtering them locally, so changing
+# the radius or repeating a search costs no 2GIS calls. numpy is imported on first use to keep
+# it off the webhook's cold-start path.
+logger = logging.getLogger(__name__)
+EARTH_RADIUS_METERS = 6371008.8
+NEARBY_RADIUS = int(os.getenv("DGIS_NEARBY_RADIUS", "10000"))
+NEARBY_LRU_SIZE = int(os.getenv("NEARBY_LRU_SIZE", "256"))
+# 0 picks uniformly; otherwise a place d metres away is weighted by exp(-d / decay), both here
+# and in the order of the repeat-search queue.
+PLACE_DISTANCE_DECAY = float(os.getenv("PLACE_DISTANCE_DECAY", "0"))
+
+_index_lru = LRUCache(NEARBY_LRU_SIZE)
+
+class NearbyIndex:
+    """Places around a tile centre in the order 2GIS returned them (nearest first), with their
+    coordinates as arrays.
+
+    `complete` is False when 2GIS had more places than were fetched. Every place within `reach`
+    metres of the centre is indexed: NEARBY_RADIUS for a complete index, otherwise the distance
+    to the farthest fetched place."""
+    def __init__(self, places: list[dict], complete: bool, centre: tuple[float, float]):
+        import numpy as np
+        self.places = places; self.complete = complete; self.centre = centre
+        self.lats = np.radians(np.array([place["lat"] for place in places], dtype=np.float64))
+        self.lons = np.radians(np.array([place["lon"] for place in places], dtype=np.float64))
+        self.reach = float(NEARBY_RADIUS if complete else (self.distances(*centre).max() if places else 0.0))
+
+    def __len__(self) -> int:
+        return len(self.places)
+
+    def distances(self, lat: float, lon: float):
+        """Haversine distance in metres from (lat, lon) to every place."""
+        import numpy as np
+        phi = math.radians(lat)
+        a = np.sin((self.lats - phi) / 2) ** 2 + math.cos(phi) * np.cos(self.lats) * np.sin((self.lons - math.radians(lon)) / 2) ** 2
+        return 2 * EARTH_RADIUS_METERS * np.arcsin(np.sqrt(a))
+
+    def within(self, lat: float, lon: float, radius_meters: int) -> tuple:
+        """(indices, distances) of the places inside the circle."""
+        import numpy as np
+        distances = self.distances(lat, lon); indices = np.flatnonzero(distances <= radius_meters)
+        return indices, distances[indices]
+
+    def covers(self, lat: float, lon: float, radius_meters: int) -> bool:
+        """Whether every place inside the circle is in the index."""
+        # Even a complete index only holds the places within NEARBY_RADIUS of the tile centre.
+        return haversine_meters(*self.centre, lat, lon) + radius_meters <= self.reach
+
+    def candidates(self, lat: float, lon: float, radius_meters: int) -> list[dict]:
+        indices, _ = self.within(lat, lon, radius_meters)
+        return [dict(self.places[index]) for index in indices]
+
+    def random_place(self, lat: float, lon: float, radius_meters: int, decay: float = PLACE_DISTANCE_DECAY) -> dict | None:
+        indices, distances = self.within(lat, lon, radius_meters)
+        if not len(indices): return None
+        if decay <= 0: return dict(self.places[random.choice(indices)])
+        import numpy as np
+        weights = np.exp(-distances / decay)
+        return dict(self.places[random.choices(indices, weights=weights)[0]])
+
+    def to_redis(self) -> dict:
+        # The coordinates travel as raw float64 arrays; the rest of each place as JSON.
+        details = [{key: value for key, value in place.items() if key not in ("lat", "lon")} for place in self.places]
+        return {"lats": self.lats.tobytes(), "lons": self.lons.tobytes(), "places": json.dumps(details, ensure_ascii=False), "complete": int(self.complete),
+                "centre": f"{self.centre[0]},{self.centre[1]}", "reach": repr(self.reach)}
+
+    @classmethod
+    def from_redis(cls, data: dict) -> "NearbyIndex":
+        import numpy as np
+        index = cls.__new__(cls)
+        index.lats = np.frombuffer(data[b"lats"], dtype=np.float64); index.lons = np.frombuffer(data[b"lons"], dtype=np.float64)
+        index.complete = data[b"complete"] == b"1"
+        # Indexes cached before the centre and reach were stored cover nothing until they expire.
+        index.centre = tuple(float(part) for part in data.get(b"centre", b"0,0").split(b","))
+        index.reach = float(data.get(b"reach", 0))
+        index.places = [{**place, "lat": math.degrees(lat), "lon": math.degrees(lon)} for place, lat, lon in zip(json.loads(data[b"places"]), index.lats, index.lons)]
+        return index
+
+def nearby_tile(lat: float, lon: float) -> tuple[float, float, str]:
+    """The tile centre a location's index is built around, and its cache key."""
+    tile_lat, tile_lon, _ = snap_to_tile(lat, lon, NEARBY_RADIUS)
+    return tile_lat, tile_lon, f"nearby:{tile_lat:.6f},{tile_lon:.6f}"
+
+async def get_cached_index(key: str):
+    """Returns the index for a tile key from this process or Redis, or MISS."""
+    index = _index_lru.get(key)
+    if index is not MISS:
+        inc("lunchbot_cache_requests_total", cache="nearby_lru", result="hit"); return index
+    client = get_async_redis()
+    if client is None: return MISS
+    try:
+        data = await asyncio.wait_for(client.hgetall(key), REDIS_CALL_TIMEOUT)
+        inc("lunchbot_cache_requests_total", cache="nearby", result="hit" if data else "miss")
+        if not data: return MISS
+        index = NearbyIndex.from_redis(data); _index_lru.set(key, index, PLACE_CACHE_TTL); return index
+    except Exception as e:
+        inc("lunchbot_redis_errors_total", op="nearby_get")
+        logger.error(f"Failed to read nearby index {key}: {e}"); return MISS
+
+async def set_cached_index(key: str, index: NearbyIndex) -> None:
+    _index_lru.set(key, index, PLACE_CACHE_TTL)
+    client = get_async_redis()
+    if client is None: return
+    try:
+        pipe = client.pipeline()
+        pipe.delete(key); pipe.hset(key, mapping=index.to_redis()); pipe.expire(key, PLACE_CACHE_TTL)
+        await asyncio.wait_for(pipe.execute(), REDIS_CALL_TIMEOUT)
+    except Exception as e:
+        inc("lunchbot_redis_errors_total", op="nearby_set")
+        logger.error(f"Failed to write nearby index {key}: {e}")
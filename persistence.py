@@ -1,31 +1,199 @@
 # persistence.py
 import os
 import json
+import struct
+import asyncio
 import logging
-import redis
+
+from metrics import span, inc
 
 logger = logging.getLogger(__name__)
 
+KV_URL = os.getenv("KV_URL")
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", "20"))
+REDIS_POOL_TIMEOUT = float(os.getenv("REDIS_POOL_TIMEOUT", "2"))
+REDIS_CONNECT_TIMEOUT = float(os.getenv("REDIS_CONNECT_TIMEOUT", "2"))
+REDIS_SOCKET_TIMEOUT = float(os.getenv("REDIS_SOCKET_TIMEOUT", "2"))
+REDIS_CALL_TIMEOUT = float(os.getenv("REDIS_CALL_TIMEOUT", "1"))
+
 # --- Database (Vercel KV / Redis) ---
-try:
-    redis_client = redis.from_url(os.getenv("KV_URL"))
-except Exception as e:
-    logger.error(f"Could not connect to Redis: {e}")
-    redis_client = None
+# Both clients (and the redis package itself) are created on first use, so importing this
+# module costs nothing on a cold start.
+_redis_client = None
+_redis_client_created = False
+
+def get_redis():
+    """Returns the synchronous client, used by the migration helpers and offline scripts."""
+    global _redis_client, _redis_client_created
+    if not _redis_client_created:
+        _redis_client_created = True
+        try:
+            import redis
+            _redis_client = redis.from_url(KV_URL)
+        except Exception as e:
+            logger.error(f"Could not connect to Redis: {e}")
+    return _redis_client
+
+# Async client for handlers, so Redis round-trips don't block the event loop.
+_async_client = None
+_async_client_loop: asyncio.AbstractEventLoop | None = None
+
+def get_async_redis():
+    """Returns the pooled async client, creating it for the running event loop on first use."""
+    global _async_client, _async_client_loop
+    if not KV_URL: return None
+    loop = asyncio.get_running_loop()
+    # asyncio connections are bound to the loop that opened them.
+    if _async_client is None or _async_client_loop is not loop:
+        try:
+            import redis.asyncio as aioredis
+            pool = aioredis.BlockingConnectionPool.from_url(
+                KV_URL, max_connections=REDIS_MAX_CONNECTIONS, timeout=REDIS_POOL_TIMEOUT,
+                socket_connect_timeout=REDIS_CONNECT_TIMEOUT, socket_timeout=REDIS_SOCKET_TIMEOUT)
+            _async_client = aioredis.Redis(connection_pool=pool); _async_client_loop = loop
+        except Exception as e:
+            logger.error(f"Could not create async Redis client: {e}"); return None
+    return _async_client
+
+async def close_async_redis() -> None:
+    global _async_client, _async_client_loop
+    if _async_client is not None:
+        await _async_client.aclose()
+        _async_client = None; _async_client_loop = None
+
+# --- User State Schema ---
+# Each user is a Redis hash `user:{id}` with one field per user_data key, so an update
+# only rewrites the fields that changed. Older deployments stored a JSON string instead;
+# those keys are converted on first read or in bulk with `python persistence.py migrate`.
+_COORDS = struct.Struct("<dd")
+FIELD_CODECS = {
+    "last_coords": (lambda value: _COORDS.pack(*value), lambda raw: list(_COORDS.unpack(raw))),
+    "radius_km": (lambda value: repr(float(value)).encode(), lambda raw: float(raw)),
+    "city": (str.encode, bytes.decode),
+    "state": (str.encode, bytes.decode),
+    "last_address": (str.encode, bytes.decode),
+    "queue_sig": (str.encode, bytes.decode),
+}
+_JSON_CODEC = (lambda value: json.dumps(value, ensure_ascii=False).encode(), json.loads)
+
+def encode_user_fields(data: dict) -> dict:
+    return {key: FIELD_CODECS.get(key, _JSON_CODEC)[0](value) for key, value in data.items()}
+
+def decode_user_fields(raw: dict) -> dict:
+    data = {}
+    for key, value in raw.items():
+        key = key.decode() if isinstance(key, bytes) else key
+        try: data[key] = FIELD_CODECS.get(key, _JSON_CODEC)[1](value)
+        except Exception as e: logger.error(f"Dropping undecodable field {key!r}: {e}")
+    return data
+
+def _is_wrong_type(error: Exception) -> bool:
+    import redis
+    return isinstance(error, redis.ResponseError) and "WRONGTYPE" in str(error)
+
+def migrate_user_key(key: str) -> dict:
+    """Converts one legacy JSON `user:{id}` string into a hash and returns its data."""
+    redis_client = get_redis()
+    if redis_client.type(key) != b"string": return decode_user_fields(redis_client.hgetall(key))
+    user_data = json.loads(redis_client.get(key) or "{}")
+    pipe = redis_client.pipeline(transaction=True)
+    pipe.delete(key)
+    if user_data: pipe.hset(key, mapping=encode_user_fields(user_data))
+    pipe.execute()
+    return user_data
+
+def migrate_user_data() -> int:
+    """One-shot migration of every legacy JSON `user:{id}` key. Returns the number converted."""
+    redis_client = get_redis()
+    if not redis_client: return 0
+    migrated = 0
+    for key in redis_client.scan_iter(match="user:*", count=500, _type="STRING"):
+        try:
+            migrate_user_key(key.decode()); migrated += 1
+        except Exception as e:
+            logger.error(f"Failed to migrate {key!r}: {e}")
+    return migrated
 
 def load_user_data(user_id: int) -> dict:
     """Loads user data from Redis."""
+    redis_client = get_redis()
     if not redis_client: return {}
     try:
-        data = redis_client.get(f"user:{user_id}")
-        return json.loads(data) if data else {}
+        return decode_user_fields(redis_client.hgetall(f"user:{user_id}"))
+    except Exception as e:
+        if not _is_wrong_type(e):
+            logger.error(f"Failed to load data for user {user_id}: {e}"); return {}
+    try:
+        return migrate_user_key(f"user:{user_id}")
     except Exception as e:
-        logger.error(f"Failed to load data for user {user_id}: {e}"); return {}
+        logger.error(f"Failed to migrate data for user {user_id}: {e}"); return {}
 
 def save_user_data(user_id: int, data: dict) -> None:
-    """Saves user data to Redis."""
+    """Saves user data to Redis, replacing whatever was stored."""
+    redis_client = get_redis()
     if not redis_client: return
     try:
-        redis_client.set(f"user:{user_id}", json.dumps(data))
+        pipe = redis_client.pipeline(transaction=True)
+        pipe.delete(f"user:{user_id}")
+        if data: pipe.hset(f"user:{user_id}", mapping=encode_user_fields(data))
+        pipe.execute()
+    except Exception as e:
+        logger.error(f"Failed to save data for user {user_id}: {e}")
+
+async def aload_user_data(user_id: int) -> dict:
+    """Async counterpart of load_user_data."""
+    client = get_async_redis()
+    if not client: return {}
+    key = f"user:{user_id}"
+    try:
+        with span("redis", op="load_user"): raw = await asyncio.wait_for(client.hgetall(key), REDIS_CALL_TIMEOUT)
+        return decode_user_fields(raw)
     except Exception as e:
-        logger.error(f"Failed to save data for user {user_id}: {e}")
\ No newline at end of file
+        if not _is_wrong_type(e):
+            inc("lunchbot_redis_errors_total", op="load_user")
+            logger.error(f"Failed to load data for user {user_id}: {e}"); return {}
+    try:
+        data = await asyncio.wait_for(client.get(key), REDIS_CALL_TIMEOUT)
+        user_data = json.loads(data) if data else {}
+        pipe = client.pipeline(transaction=True)
+        pipe.delete(key)
+        if user_data: pipe.hset(key, mapping=encode_user_fields(user_data))
+        await asyncio.wait_for(pipe.execute(), REDIS_CALL_TIMEOUT)
+        return user_data
+    except Exception as e:
+        inc("lunchbot_redis_errors_total", op="migrate_user")
+        logger.error(f"Failed to migrate data for user {user_id}: {e}"); return {}
+
+async def asave_user_data(user_id: int, data: dict) -> None:
+    """Async counterpart of save_user_data."""
+    client = get_async_redis()
+    if not client: return
+    try:
+        pipe = client.pipeline(transaction=True)
+        pipe.delete(f"user:{user_id}")
+        if data: pipe.hset(f"user:{user_id}", mapping=encode_user_fields(data))
+        with span("redis", op="save_user"): await asyncio.wait_for(pipe.execute(), REDIS_CALL_TIMEOUT)
+    except Exception as e:
+        inc("lunchbot_redis_errors_total", op="save_user")
+        logger.error(f"Failed to save data for user {user_id}: {e}")
+
+async def asave_user_fields(user_id: int, changed: dict, removed: list) -> None:
+    """Writes only the fields that changed and deletes the ones that were removed."""
+    client = get_async_redis()
+    if not client or not (changed or removed): return
+    try:
+        pipe = client.pipeline(transaction=True)
+        if changed: pipe.hset(f"user:{user_id}", mapping=encode_user_fields(changed))
+        if removed: pipe.hdel(f"user:{user_id}", *removed)
+        with span("redis", op="save_user"): await asyncio.wait_for(pipe.execute(), REDIS_CALL_TIMEOUT)
+    except Exception as e:
+        inc("lunchbot_redis_errors_total", op="save_user")
+        logger.error(f"Failed to save data for user {user_id}: {e}")
+
+if __name__ == "__main__":
+    import sys
+    if sys.argv[1:] == ["migrate"]:
+        logging.basicConfig(level=logging.INFO)
+        logger.info(f"Migrated {migrate_user_data()} user keys to hashes.")
+    else:
+        print("usage: python persistence.py migrate")
@@ -0,0 +1,192 @@
+# place_sources.py
+import os
+import json
+import math
+import bisect
+import random
+import logging
+import itertools
+from abc import ABC, abstractmethod
+from array import array
+from collections import defaultdict
+from typing import Awaitable, Callable
+
+logger = logging.getLogger(__name__)
+
+EARTH_RADIUS_METERS = 6371008.8
+METERS_PER_DEGREE = 111320.0
+LOCAL_PLACES_CELL_DEG = float(os.getenv("LOCAL_PLACES_CELL_DEG", "0.01"))
+LOCAL_PLACES_MIN_CANDIDATES = int(os.getenv("LOCAL_PLACES_MIN_CANDIDATES", "1"))
+REJECTION_SAMPLING_TRIES = 16
+
+def haversine_meters(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi = phi2 - phi1; dlambda = math.radians(lon2 - lon1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
+    return 2 * EARTH_RADIUS_METERS * math.asin(math.sqrt(a))
+
+def normalize_place(item: dict) -> dict | None:
+    """Accepts a raw 2GIS item or an already formatted place; returns the bot's place dict."""
+    if "lat" in item and "lon" in item:
+        lat, lon = item["lat"], item["lon"]
+    else:
+        point = item.get("point_info", {}).get("point") or item.get("point") or {}
+        lat, lon = point.get("lat"), point.get("lon")
+    if lat is None or lon is None: return None
+    place_id = item.get("id") or f"{item.get('name', '')}@{float(lat):.6f},{float(lon):.6f}"
+    return {"id": place_id, "name": item.get("name", "N/A"), "address": item.get("address", item.get("address_name", "")), "url": item.get("url", ""), "lat": float(lat), "lon": float(lon)}
+
+# --- Place Sources ---
+class PlaceSource(ABC):
+    """Answers "a random lunch place within radius_meters of (lat, lon)"."""
+    name = "base"
+
+    @abstractmethod
+    async def random_place(self, lat: float, lon: float, radius_meters: int) -> dict | None: ...
+
+    @abstractmethod
+    async def candidates(self, lat: float, lon: float, radius_meters: int) -> list[dict]:
+        """Every place the source would choose from, each with a stable "id"."""
+
+class DgisPlaceSource(PlaceSource):
+    """Live 2GIS search."""
+    name = "2gis"
+
+    def __init__(self, search: Callable[[float, float, int], Awaitable[dict | None]], list_candidates: Callable[[float, float, int], Awaitable[list[dict]]]):
+        self.search = search; self.list_candidates = list_candidates
+
+    async def random_place(self, lat: float, lon: float, radius_meters: int) -> dict | None:
+        return await self.search(lat, lon, radius_meters)
+
+    async def candidates(self, lat: float, lon: float, radius_meters: int) -> list[dict]:
+        return await self.list_candidates(lat, lon, radius_meters)
+
+class LocalPlaceSource(PlaceSource):
+    """An offline snapshot of places in flat coordinate arrays, bucketed into a lat/lon grid."""
+    name = "local"
+
+    def __init__(self, places: list[dict], cell_deg: float = LOCAL_PLACES_CELL_DEG, min_candidates: int = LOCAL_PLACES_MIN_CANDIDATES):
+        self.cell_deg = cell_deg; self.min_candidates = min_candidates
+        self.lats = array("d"); self.lons = array("d"); self.places = []
+        cells = defaultdict(lambda: array("I"))
+        for item in places:
+            place = normalize_place(item)
+            if place is None: continue
+            index = len(self.places)
+            self.places.append(place); self.lats.append(place["lat"]); self.lons.append(place["lon"])
+            cells[self._cell(place["lat"], place["lon"])].append(index)
+        self.cells = dict(cells)
+
+    @classmethod
+    def from_file(cls, path: str, **kwargs) -> "LocalPlaceSource":
+        """Loads a JSON array or newline-delimited JSON of 2GIS items / place dicts."""
+        with open(path, encoding="utf-8") as f:
+            text = f.read()
+        places = json.loads(text) if text.lstrip().startswith("[") else [json.loads(line) for line in text.splitlines() if line.strip()]
+        return cls(places, **kwargs)
+
+    def __len__(self) -> int:
+        return len(self.places)
+
+    def _cell(self, lat: float, lon: float) -> tuple[int, int]:
+        return math.floor(lat / self.cell_deg), math.floor(lon / self.cell_deg)
+
+    def _covering_cells(self, lat: float, lon: float, radius_meters: int) -> list:
+        dlat = radius_meters / METERS_PER_DEGREE
+        dlon = radius_meters / (METERS_PER_DEGREE * max(math.cos(math.radians(lat)), 1e-6))
+        row_min, col_min = self._cell(lat - dlat, lon - dlon); row_max, col_max = self._cell(lat + dlat, lon + dlon)
+        return [self.cells[(row, col)] for row in range(row_min, row_max + 1) for col in range(col_min, col_max + 1) if (row, col) in self.cells]
+
+    def indices_within(self, lat: float, lon: float, radius_meters: int) -> list[int]:
+        return [index for cell in self._covering_cells(lat, lon, radius_meters) for index in cell
+                if haversine_meters(lat, lon, self.lats[index], self.lons[index]) <= radius_meters]
+
+    async def random_place(self, lat: float, lon: float, radius_meters: int) -> dict | None:
+        cells = self._covering_cells(lat, lon, radius_meters)
+        if self.min_candidates <= 1:
+            # Rejection sampling: a uniform point from the covering cells that lands inside the
+            # circle is a uniform point from the circle, usually after two or three draws.
+            offsets = list(itertools.accumulate(len(cell) for cell in cells))
+            for _ in range(REJECTION_SAMPLING_TRIES if offsets else 0):
+                draw = random.randrange(offsets[-1]); cell_num = bisect.bisect_right(offsets, draw)
+                index = cells[cell_num][draw - (offsets[cell_num - 1] if cell_num else 0)]
+                if haversine_meters(lat, lon, self.lats[index], self.lons[index]) <= radius_meters: return dict(self.places[index])
+        found = self.indices_within(lat, lon, radius_meters)
+        # Too few hits means the snapshot doesn't really cover this area.
+        if not found or len(found) < self.min_candidates: return None
+        return dict(self.places[random.choice(found)])
+
+    async def candidates(self, lat: float, lon: float, radius_meters: int) -> list[dict]:
+        found = self.indices_within(lat, lon, radius_meters)
+        if len(found) < self.min_candidates: return []
+        return [dict(self.places[index]) for index in found]
+
+class FallbackPlaceSource(PlaceSource):
+    """Tries each source in order and returns the first place found."""
+    name = "fallback"
+
+    def __init__(self, sources: list[PlaceSource]):
+        self.sources = sources
+
+    async def random_place(self, lat: float, lon: float, radius_meters: int) -> dict | None:
+        for source in self.sources:
+            try:
+                place = await source.random_place(lat, lon, radius_meters)
+            except Exception as e:
+                logger.error(f"Place source {source.name} failed: {e}"); continue
+            if place: return place
+        return None
+
+    async def candidates(self, lat: float, lon: float, radius_meters: int) -> list[dict]:
+        for source in self.sources:
+            try:
+                found = await source.candidates(lat, lon, radius_meters)
+            except Exception as e:
+                logger.error(f"Place source {source.name} failed: {e}"); continue
+            if found: return found
+        return []
+
+def build_place_source(mode: str, dgis_search: Callable[[float, float, int], Awaitable[dict | None]], dgis_candidates: Callable[[float, float, int], Awaitable[list[dict]]], local_path: str | None) -> PlaceSource:
+    """mode: "2gis", "local", "local_first" (local, then 2GIS) or "2gis_first" (2GIS, then local)."""
+    dgis = DgisPlaceSource(dgis_search, dgis_candidates)
+    if mode == "2gis" or not local_path: return dgis
+    try:
+        local = LocalPlaceSource.from_file(local_path)
+        logger.info(f"Loaded {len(local)} local places from {local_path}")
+    except Exception as e:
+        logger.error(f"Could not load local places from {local_path}: {e}"); return dgis
+    if mode == "local": return local
+    if mode == "local_first": return FallbackPlaceSource([local, dgis])
+    return FallbackPlaceSource([dgis, local])
+
+def export_cached_places(path: str) -> int:
+    """Writes every 2GIS item currently in the Redis page cache and nearby indexes to `path` as a JSON snapshot."""
+    from persistence import get_redis
+    from nearby import NearbyIndex
+    redis_client = get_redis()
+    if not redis_client: return 0
+    places = {}
+    for key in redis_client.scan_iter(match="places:*", count=500):
+        if key == b"places:index": continue
+        data = redis_client.get(key)
+        if not data: continue
+        for item in json.loads(data)["items"]:
+            place = normalize_place(item)
+            if place: places[item.get("id") or (place["name"], place["lat"], place["lon"])] = place
+    for key in redis_client.scan_iter(match="nearby:*", count=500, _type="HASH"):
+        data = redis_client.hgetall(key)
+        if not data: continue
+        for item in NearbyIndex.from_redis(data).places:
+            place = normalize_place(item)
+            if place: places[item.get("id") or (place["name"], place["lat"], place["lon"])] = place
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(list(places.values()), f, ensure_ascii=False)
+    return len(places)
+
+if __name__ == "__main__":
+    import sys
+    if len(sys.argv) == 3 and sys.argv[1] == "export":
+        logging.basicConfig(level=logging.INFO)
+        logger.info(f"Exported {export_cached_places(sys.argv[2])} places to {sys.argv[2]}.")
+    else:
+        print("usage: python place_sources.py export <snapshot.json>")
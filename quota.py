@@ -0,0 +1,145 @@
+# quota.py
+import os
+import time
+import uuid
+import asyncio
+import logging
+
+from persistence import get_async_redis, REDIS_CALL_TIMEOUT
+from caches import MISS
+from metrics import inc
+
+logger = logging.getLogger(__name__)
+
+# --- Shared 2GIS Rate Limit ---
+# Every instance spends tokens from one Redis bucket, refilled at DGIS_RATE_LIMIT requests/s
+# up to DGIS_RATE_BURST. Without Redis (or if it fails) calls go through unmetered.
+DGIS_RATE_LIMIT = float(os.getenv("DGIS_RATE_LIMIT", "10"))
+DGIS_RATE_BURST = float(os.getenv("DGIS_RATE_BURST", "20"))
+# How long a call may wait for a token before it is refused.
+DGIS_QUOTA_WAIT = float(os.getenv("DGIS_QUOTA_WAIT", "1"))
+# Below this many tokens, searches fetch at most DGIS_QUOTA_LOW_PAGES pages.
+DGIS_QUOTA_LOW = float(os.getenv("DGIS_QUOTA_LOW", "5"))
+DGIS_QUOTA_LOW_PAGES = int(os.getenv("DGIS_QUOTA_LOW_PAGES", "3"))
+QUOTA_KEY = "quota:dgis"
+
+# Refills by elapsed server time, then takes `cost` tokens if there are enough.
+# Returns {allowed, tokens left}; tokens as a string because Lua numbers come back truncated.
+TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1]); local burst = tonumber(ARGV[2]); local cost = tonumber(ARGV[3])
+local clock = redis.call('TIME'); local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or burst; local ts = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+local allowed = 0
+if tokens >= cost then tokens = tokens - cost; allowed = 1 end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return {allowed, tostring(tokens)}
+"""
+
+class QuotaExceeded(Exception):
+    """No 2GIS token became available within DGIS_QUOTA_WAIT."""
+
+_script = None
+_script_client = None
+_tokens_left: float | None = None
+
+def quota_enabled() -> bool:
+    return DGIS_RATE_LIMIT > 0 and get_async_redis() is not None
+
+def budget_low() -> bool:
+    """True when the last bucket reading in this process was under DGIS_QUOTA_LOW."""
+    return _tokens_left is not None and _tokens_left < DGIS_QUOTA_LOW
+
+async def _take(client, cost: float) -> tuple[bool, float]:
+    global _script, _script_client
+    if _script is None or _script_client is not client:
+        _script = client.register_script(TOKEN_BUCKET_SCRIPT); _script_client = client
+    allowed, tokens = await asyncio.wait_for(_script(keys=[QUOTA_KEY], args=[DGIS_RATE_LIMIT, DGIS_RATE_BURST, cost], client=client), REDIS_CALL_TIMEOUT)
+    return bool(allowed), float(tokens)
+
+async def acquire(cost: float = 1, wait: float = DGIS_QUOTA_WAIT) -> None:
+    """Takes `cost` tokens, waiting up to `wait` seconds for the bucket to refill. Raises QuotaExceeded."""
+    global _tokens_left
+    if not quota_enabled(): return
+    client = get_async_redis(); deadline = time.monotonic() + wait
+    while True:
+        try:
+            allowed, _tokens_left = await _take(client, cost)
+        except Exception as e:
+            inc("lunchbot_redis_errors_total", op="quota")
+            logger.error(f"2GIS quota check failed, letting the call through: {e}"); return
+        if allowed: return
+        delay = (cost - _tokens_left) / DGIS_RATE_LIMIT
+        if time.monotonic() + delay > deadline:
+            inc("lunchbot_quota_denied_total"); raise QuotaExceeded(f"2GIS budget exhausted ({_tokens_left:.1f} tokens left)")
+        await asyncio.sleep(delay)
+
+# --- Single Flight ---
+# Concurrent identical requests share one upstream call: in-process through a shared future,
+# across instances through a short Redis marker while followers poll the result cache.
+SINGLE_FLIGHT_TTL = float(os.getenv("SINGLE_FLIGHT_TTL", "5"))
+SINGLE_FLIGHT_WAIT = float(os.getenv("SINGLE_FLIGHT_WAIT", "2"))
+SINGLE_FLIGHT_POLL = 0.05
+
+_inflight: dict[str, asyncio.Future] = {}
+
+async def _claim(key: str) -> str | None:
+    """Returns a token if this instance should make the call, None if another one already is."""
+    client = get_async_redis(); token = uuid.uuid4().hex
+    if client is None: return token
+    try:
+        claimed = await asyncio.wait_for(client.set(f"inflight:{key}", token, nx=True, px=int(SINGLE_FLIGHT_TTL * 1000)), REDIS_CALL_TIMEOUT)
+    except Exception as e:
+        inc("lunchbot_redis_errors_total", op="single_flight"); logger.error(f"Single-flight claim for {key} failed: {e}"); return token
+    return token if claimed else None
+
+async def _release(key: str, token: str) -> None:
+    client = get_async_redis()
+    if client is None: return
+    try:
+        if await asyncio.wait_for(client.get(f"inflight:{key}"), REDIS_CALL_TIMEOUT) == token.encode():
+            await asyncio.wait_for(client.delete(f"inflight:{key}"), REDIS_CALL_TIMEOUT)
+    except Exception as e:
+        logger.error(f"Single-flight release for {key} failed: {e}")
+
+async def _lead(key: str, fetch, peek):
+    if peek is None: return await fetch()
+    token = await _claim(key)
+    if token is None:
+        # Another instance is fetching; its result lands in the cache that `peek` reads.
+        deadline = time.monotonic() + SINGLE_FLIGHT_WAIT
+        while time.monotonic() < deadline:
+            await asyncio.sleep(SINGLE_FLIGHT_POLL)
+            value = await peek()
+            if value is not MISS:
+                inc("lunchbot_single_flight_total", role="remote_follower"); return value
+        # The other call is slow or died; fetch it ourselves.
+        token = await _claim(key)
+    try:
+        return await fetch()
+    finally:
+        if token: await _release(key, token)
+
+async def single_flight(key: str, fetch, peek=None):
+    """Runs fetch() once per key across concurrent callers.
+
+    peek() reads the shared cache the fetch fills and returns MISS until the result is there;
+    without it, calls are only coalesced within this process."""
+    future = _inflight.get(key)
+    if future is not None and future.get_loop() is asyncio.get_running_loop():
+        inc("lunchbot_single_flight_total", role="follower")
+        return await asyncio.shield(future)
+    future = asyncio.get_running_loop().create_future(); _inflight[key] = future
+    inc("lunchbot_single_flight_total", role="leader")
+    try:
+        value = await _lead(key, fetch, peek)
+        future.set_result(value); return value
+    except asyncio.CancelledError:
+        future.cancel(); raise
+    except Exception as e:
+        # Followers re-raise it; mark it retrieved so a lone leader doesn't log a warning.
+        future.set_exception(e); future.exception(); raise
+    finally:
+        if _inflight.get(key) is future: del _inflight[key]
@@ -0,0 +1,92 @@
+# resilience.py
+import time
+import asyncio
+import logging
+import contextvars
+from contextlib import contextmanager
+
+from metrics import inc
+
+logger = logging.getLogger(__name__)
+
+# --- Deadlines ---
+# A search sets one deadline; every upstream call made for it (in any task it spawns) is
+# cut short when the deadline passes, so the search returns with whatever already arrived.
+_deadline: contextvars.ContextVar[float | None] = contextvars.ContextVar("deadline", default=None)
+
+@contextmanager
+def deadline(seconds: float):
+    """Bounds the calls inside the block to `seconds` from now (or an earlier enclosing deadline)."""
+    at = time.monotonic() + seconds; outer = _deadline.get()
+    token = _deadline.set(min(at, outer) if outer is not None else at)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+def remaining(default: float) -> float:
+    """Seconds left until the current deadline, capped at `default`."""
+    at = _deadline.get()
+    return default if at is None else max(0.0, min(default, at - time.monotonic()))
+
+# --- Circuit Breaker ---
+class CircuitOpen(Exception):
+    """The upstream is considered down; the call was not made."""
+
+class CircuitBreaker:
+    """Opens after `failures` consecutive failed calls and fails fast for `cooldown` seconds;
+    then lets a single probe through, which closes it again on success."""
+    def __init__(self, name: str, failures: int, cooldown: float):
+        self.name = name; self.failures = failures; self.cooldown = cooldown
+        self.state = "closed"; self.consecutive_failures = 0; self.opened_at = 0.0; self.probing = False
+
+    def _transition(self, state: str) -> None:
+        if state == self.state: return
+        logger.warning(f"Circuit {self.name}: {self.state} -> {state}")
+        self.state = state; inc("lunchbot_circuit_transitions_total", circuit=self.name, state=state)
+
+    def before_call(self) -> None:
+        """Raises CircuitOpen unless the call may go ahead."""
+        if self.failures <= 0 or self.state == "closed": return
+        if self.state == "open" and time.monotonic() - self.opened_at >= self.cooldown: self._transition("half_open")
+        if self.state == "half_open" and not self.probing:
+            self.probing = True; return
+        inc("lunchbot_circuit_rejected_total", circuit=self.name)
+        raise CircuitOpen(f"{self.name} circuit is {self.state}")
+
+    def record_success(self) -> None:
+        self.consecutive_failures = 0; self.probing = False; self._transition("closed")
+
+    def record_abandoned(self) -> None:
+        """The call ended without a verdict (cancelled, or cut off by our own deadline)."""
+        self.probing = False
+
+    def record_failure(self) -> None:
+        self.consecutive_failures += 1; self.probing = False
+        if self.state == "half_open" or (self.failures > 0 and self.consecutive_failures >= self.failures):
+            self.opened_at = time.monotonic(); self._transition("open")
+
+# --- Hedged Requests ---
+async def hedged(call, delay: float, name: str):
+    """Awaits call(); if it is still running after `delay` seconds, or has already failed, makes
+    one more call() and returns whichever succeeds first. delay <= 0 disables hedging."""
+    if delay <= 0: return await call()
+    primary = asyncio.ensure_future(call()); tasks = [primary]
+    try:
+        await asyncio.wait(tasks, timeout=delay)
+        if primary.done() and primary.exception() is None: return primary.result()
+        inc("lunchbot_hedged_requests_total", call=name, result="sent")
+        tasks.append(asyncio.ensure_future(call()))
+        error = primary.exception() if primary.done() else None
+        pending = {task for task in tasks if not task.done()}
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    inc("lunchbot_hedged_requests_total", call=name, result="primary_won" if task is primary else "hedge_won")
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in tasks:
+            if not task.done(): task.cancel()
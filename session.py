@@ -0,0 +1,33 @@
+# session.py
+import copy
+import logging
+from contextlib import asynccontextmanager
+from telegram import Update
+from telegram.ext import Application
+
+from persistence import get_async_redis, aload_user_data, asave_user_fields
+
+logger = logging.getLogger(__name__)
+
+def changed_fields(before: dict, after: dict) -> tuple[dict, list]:
+    """Returns (fields that were added or modified, fields that were removed)."""
+    changed = {key: value for key, value in after.items() if key not in before or before[key] != value}
+    removed = [key for key in before if key not in after]
+    return changed, removed
+
+@asynccontextmanager
+async def user_session(application: Application, update: Update):
+    """Loads `user:{id}` into context.user_data once per update and writes back only the fields that changed."""
+    user = update.effective_user
+    # Without Redis, application.user_data is the only copy; keep it for the life of the process.
+    if user is None or get_async_redis() is None:
+        yield; return
+    user_data = application.user_data[user.id]
+    # Always reload: another worker may have handled this user's previous update.
+    user_data.clear(); user_data.update(await aload_user_data(user.id))
+    snapshot = copy.deepcopy(user_data)
+    try:
+        yield
+    finally:
+        changed, removed = changed_fields(snapshot, user_data)
+        if changed or removed: await asave_user_fields(user.id, changed, removed)
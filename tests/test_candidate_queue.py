@@ -0,0 +1,23 @@
+import sys
+from pathlib import Path
+from collections import Counter
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from candidate_queue import shuffled_ids
+
+# Five places 0, 1, 2, 3 and 4 km north of the search point.
+CANDIDATES = [{"id": str(i), "lat": 43.2 + i * 1000 / 111195, "lon": 76.9} for i in range(5)]
+
+def test_uniform_shuffle_keeps_every_id():
+    assert sorted(shuffled_ids(CANDIDATES, 43.2, 76.9, decay=0)) == ["0", "1", "2", "3", "4"]
+
+def test_decay_puts_nearer_places_first_in_proportion():
+    firsts = Counter(shuffled_ids(CANDIDATES, 43.2, 76.9, decay=1000)[0] for _ in range(5000))
+    # Weights exp(-d / 1000) give the nearest place ~64% of first picks and the farthest ~1%.
+    assert 0.58 < firsts["0"] / 5000 < 0.70 and firsts["4"] < firsts["3"] < firsts["2"] < firsts["1"]
+
+def test_decay_handles_missing_and_distant_coordinates():
+    candidates = CANDIDATES + [{"id": "no_coords", "lat": None, "lon": None}, {"id": "far", "lat": 80.0, "lon": 0.0}]
+    ids = shuffled_ids(candidates, 43.2, 76.9, decay=10)
+    assert sorted(ids) == sorted(place["id"] for place in candidates) and ids[0] == "0"
@@ -0,0 +1,58 @@
+import sys
+import asyncio
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import dgis
+import nearby
+from bench.fake_services import fake_dgis
+from http_client import close_http_clients
+
+LAT, LON = 43.2381, 76.9452
+
+def search_costs(service, radii) -> list[int]:
+    """2GIS requests made by each search, in order."""
+    async def run():
+        costs = []
+        try:
+            for radius in radii:
+                before = service.request_count
+                assert await dgis.get_random_lunch_place(LAT, LON, radius) is not None
+                costs.append(service.request_count - before)
+        finally:
+            await close_http_clients()
+        return costs
+    return asyncio.run(run())
+
+@pytest.fixture
+def nearby_mode(monkeypatch):
+    monkeypatch.setattr(dgis, "DGIS_SAMPLING", "nearby")
+    monkeypatch.setattr(dgis, "breaker", dgis.CircuitBreaker("test", 0, 0))
+    nearby._index_lru.clear()
+    yield
+    nearby._index_lru.clear()
+
+def test_sparse_area_answers_radius_changes_from_the_index(nearby_mode, monkeypatch):
+    with fake_dgis(total_places=80) as service:
+        monkeypatch.setattr(dgis, "DGIS_BASE_URL", f"{service.url}/3.0")
+        assert search_costs(service, [1000, 2000, 500]) == [8, 0, 0]
+
+def test_dense_area_searches_the_radius_directly(nearby_mode, monkeypatch):
+    with fake_dgis(total_places=500) as service:
+        monkeypatch.setattr(dgis, "DGIS_BASE_URL", f"{service.url}/3.0")
+        # Page 1 shows the area is dense: the index keeps only that page, and each radius is
+        # fetched like a full scan instead of walking all ten 10 km pages first.
+        assert search_costs(service, [1000, 2000]) == [1 + dgis.MAX_PAGES, dgis.MAX_PAGES]
+        index = asyncio.run(dgis.get_nearby_index(LAT, LON))
+        assert len(index) == dgis.PAGE_SIZE and not index.complete
+
+def test_index_without_a_total_is_not_complete(nearby_mode, monkeypatch):
+    async def page_without_total(lat, lon, radius_meters, page_num, sort=None):
+        items = [{"id": "1", "name": "p", "point_info": {"point": {"lat": LAT, "lon": LON}}}]
+        return (items, None) if page_num == 1 else ([], None)
+    monkeypatch.setattr(dgis, "fetch_places_page", page_without_total)
+    index = asyncio.run(dgis.get_nearby_index(LAT, LON))
+    assert not index.complete and not index.covers(LAT, LON, 1000)
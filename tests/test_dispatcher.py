@@ -0,0 +1,108 @@
+import sys
+import asyncio
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from telegram import Update
+
+import dispatcher
+from dispatcher import update_kind
+
+def message(text):
+    return SimpleNamespace(callback_query=None, message=SimpleNamespace(text=text))
+
+def callback(data):
+    return SimpleNamespace(callback_query=SimpleNamespace(data=data), message=None)
+
+@pytest.mark.parametrize("update, kind", [
+    (message("/radius 3"), "/radius"),
+    (message("/Start@lunch_bot"), "/start"),
+    (message("/anything_a_user_types"), "command:other"),
+    (message("Абая 10"), "text"),
+    (SimpleNamespace(callback_query=None, message=None), "other"),
+    (callback("repeat_search"), "callback:repeat_search"),
+    (callback("forged-data-123"), "callback:other"),
+])
+def test_update_kind_labels_are_bounded(update, kind):
+    assert update_kind(update) == kind
+
+# --- Update claims ---
+@pytest.fixture
+def redis(monkeypatch):
+    import fakeredis
+    client = fakeredis.FakeAsyncRedis()
+    monkeypatch.setattr(dispatcher, "get_async_redis", lambda: client)
+    dispatcher._recent_update_ids.clear()
+    yield client
+    dispatcher._recent_update_ids.clear()
+
+def new_process():
+    """Forgets the in-process claims, as a second worker or a restarted one would."""
+    dispatcher._recent_update_ids.clear()
+
+def update(update_id: int) -> Update:
+    return Update(update_id)
+
+def claim(*update_ids: int) -> list[int]:
+    return [fresh.update_id for fresh in asyncio.run(dispatcher.claim_updates([update(update_id) for update_id in update_ids]))]
+
+def test_failed_attempt_releases_the_claim(redis):
+    assert claim(1) == [1]
+    asyncio.run(dispatcher.finish_update(update(1), done=False))
+    assert claim(1) == [1]
+    new_process(); asyncio.run(dispatcher.finish_update(update(1), done=False))
+    assert claim(1) == [1]
+
+def test_finished_update_stays_claimed(redis):
+    assert claim(1) == [1]
+    asyncio.run(dispatcher.finish_update(update(1), done=True))
+    new_process()
+    assert claim(1) == []
+    assert 0 < asyncio.run(redis.ttl("update:1")) <= dispatcher.UPDATE_DEDUP_TTL
+
+def test_unfinished_claim_lapses_quickly(redis):
+    assert claim(1) == [1]
+    assert asyncio.run(redis.get("update:1")) == b"processing"
+    assert 0 < asyncio.run(redis.ttl("update:1")) <= dispatcher.UPDATE_CLAIM_TTL
+
+def test_redelivery_after_a_failed_dispatch_is_processed(redis):
+    attempts = []
+    async def process_update(update):
+        attempts.append(update.update_id)
+        if len(attempts) == 1: raise RuntimeError("2GIS exploded")
+    application = SimpleNamespace(process_update=process_update)
+    for _ in range(3): asyncio.run(dispatcher.dispatch_updates(application, [update(5)]))
+    assert attempts == [5, 5]
+
+def test_in_process_claims_without_redis(monkeypatch):
+    monkeypatch.setattr(dispatcher, "get_async_redis", lambda: None)
+    new_process()
+    assert claim(1, 2) == [1, 2]
+    assert claim(2, 3) == [3]
+
+def test_second_process_cannot_claim_the_same_update(redis):
+    assert claim(1, 2) == [1, 2]
+    new_process()
+    assert claim(2, 3) == [3]
+    assert asyncio.run(redis.get("update:2")) == b"processing"
+
+def test_redis_failure_lets_updates_through(monkeypatch):
+    class BrokenPipeline:
+        def set(self, *args, **kwargs): pass
+        async def execute(self): raise ConnectionError("redis is down")
+    monkeypatch.setattr(dispatcher, "get_async_redis", lambda: SimpleNamespace(pipeline=lambda transaction: BrokenPipeline()))
+    new_process()
+    assert claim(1, 2) == [1, 2]
+    # The in-process claim still catches a redelivery to this process.
+    assert claim(1) == []
+
+def test_in_process_claims_are_bounded(monkeypatch):
+    monkeypatch.setattr(dispatcher, "get_async_redis", lambda: None)
+    monkeypatch.setattr(dispatcher, "UPDATE_DEDUP_RECENT", 3)
+    new_process()
+    assert claim(1, 2, 3, 4, 5) == [1, 2, 3, 4, 5]
+    assert list(dispatcher._recent_update_ids) == [3, 4, 5] and claim(1) == [1]
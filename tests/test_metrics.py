@@ -0,0 +1,14 @@
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import metrics
+
+def test_total_sums_a_counter_over_its_labels():
+    before = metrics.total("test_requests_total")
+    metrics.inc("test_requests_total", stage="page", outcome="ok")
+    metrics.inc("test_requests_total", 2, stage="page", outcome="timeout")
+    metrics.inc("test_other_total", 5)
+    assert metrics.total("test_requests_total") - before == 3
+    assert metrics.value("test_requests_total", stage="page", outcome="ok") >= 1
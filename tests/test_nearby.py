@@ -0,0 +1,33 @@
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from nearby import NEARBY_RADIUS, NearbyIndex
+
+CENTRE = (43.238, 76.945)
+
+def places_north(*metres: float) -> list[dict]:
+    # One degree of latitude is ~111.2 km.
+    return [{"id": str(i), "name": f"p{i}", "lat": CENTRE[0] + m / 111195, "lon": CENTRE[1]} for i, m in enumerate(metres)]
+
+def test_complete_index_covers_up_to_nearby_radius_from_the_centre():
+    index = NearbyIndex(places_north(100, 500), True, CENTRE)
+    assert index.reach == NEARBY_RADIUS and index.covers(*CENTRE, NEARBY_RADIUS)
+    # From 150 m off-centre a full 10 km circle pokes out of the indexed one.
+    off_centre = (CENTRE[0] + 150 / 111195, CENTRE[1])
+    assert index.covers(*off_centre, NEARBY_RADIUS - 200) and not index.covers(*off_centre, NEARBY_RADIUS)
+
+def test_partial_index_covers_only_up_to_the_farthest_place():
+    index = NearbyIndex(places_north(100, 500, 900), False, CENTRE)
+    assert abs(index.reach - 900) < 1
+    assert index.covers(*CENTRE, 800) and not index.covers(*CENTRE, 1000)
+    # A search point 300 m from the centre sees a smaller covered radius.
+    assert not index.covers(CENTRE[0] + 300 / 111195, CENTRE[1], 700)
+
+def test_round_trip_through_redis_keeps_coverage():
+    index = NearbyIndex(places_north(100, 500, 900), False, CENTRE)
+    data = {key.encode(): value if isinstance(value, bytes) else str(value).encode() for key, value in index.to_redis().items()}
+    restored = NearbyIndex.from_redis(data)
+    assert restored.reach == index.reach and restored.centre == CENTRE and not restored.complete
+    assert [place["id"] for place in restored.candidates(*CENTRE, 600)] == ["0", "1"]
@@ -0,0 +1,69 @@
+import sys
+import json
+import asyncio
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import persistence
+from persistence import encode_user_fields, decode_user_fields
+
+USER = {"city": "Алматы", "state": "awaiting_address", "last_address": "Алматы, Абая 10",
+        "last_coords": [43.238949, 76.889709], "radius_km": 2.5, "queue_sig": "43.239000,76.889000:2500"}
+
+@pytest.fixture
+def redis(monkeypatch):
+    import fakeredis
+    server = fakeredis.FakeServer()
+    sync_client, async_client = fakeredis.FakeRedis(server=server), fakeredis.FakeAsyncRedis(server=server)
+    monkeypatch.setattr(persistence, "get_redis", lambda: sync_client)
+    monkeypatch.setattr(persistence, "get_async_redis", lambda: async_client)
+    return sync_client
+
+def test_fields_round_trip():
+    assert decode_user_fields(encode_user_fields(USER)) == USER
+
+def test_coordinates_are_two_packed_doubles():
+    raw = encode_user_fields({"last_coords": (43.238949, 76.889709)})["last_coords"]
+    assert len(raw) == 16 and decode_user_fields({b"last_coords": raw})["last_coords"] == [43.238949, 76.889709]
+
+def test_unknown_fields_fall_back_to_json():
+    raw = encode_user_fields({"history": [{"id": "1"}]})
+    assert raw == {"history": b'[{"id": "1"}]'} and decode_user_fields(raw) == {"history": [{"id": "1"}]}
+
+def test_undecodable_field_is_dropped_not_fatal():
+    assert decode_user_fields({b"radius_km": b"far", b"city": "Астана".encode()}) == {"city": "Астана"}
+
+def test_migrate_user_key_turns_legacy_json_into_a_hash(redis):
+    redis.set("user:1", json.dumps(USER))
+    assert persistence.migrate_user_key("user:1") == USER
+    assert redis.type("user:1") == b"hash" and decode_user_fields(redis.hgetall("user:1")) == USER
+    # Already a hash: read back unchanged.
+    assert persistence.migrate_user_key("user:1") == USER
+
+def test_migrate_user_data_converts_only_legacy_keys(redis):
+    redis.set("user:1", json.dumps(USER)); redis.set("user:2", "{}")
+    redis.hset("user:3", mapping=encode_user_fields({"city": "Астана"}))
+    assert persistence.migrate_user_data() == 2
+    assert redis.type("user:1") == b"hash" and not redis.exists("user:2")
+    assert persistence.load_user_data(3) == {"city": "Астана"}
+
+def test_sync_load_migrates_on_read(redis):
+    redis.set("user:1", json.dumps(USER))
+    assert persistence.load_user_data(1) == USER and redis.type("user:1") == b"hash"
+
+def test_async_load_migrates_on_read(redis):
+    redis.set("user:1", json.dumps(USER))
+    assert asyncio.run(persistence.aload_user_data(1)) == USER
+    assert redis.type("user:1") == b"hash" and asyncio.run(persistence.aload_user_data(1)) == USER
+
+def test_save_then_partial_update(redis):
+    persistence.save_user_data(1, USER)
+    asyncio.run(persistence.asave_user_fields(1, {"radius_km": 3.0}, ["state"]))
+    expected = {**USER, "radius_km": 3.0}; del expected["state"]
+    assert persistence.load_user_data(1) == expected
+
+def test_missing_user_loads_empty(redis):
+    assert persistence.load_user_data(42) == {} and asyncio.run(persistence.aload_user_data(42)) == {}
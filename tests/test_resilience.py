@@ -0,0 +1,81 @@
+import sys
+import time
+import asyncio
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import dgis
+from quota import QuotaExceeded
+from resilience import CircuitBreaker, CircuitOpen
+
+def open_breaker(cooldown: float = 60) -> CircuitBreaker:
+    breaker = CircuitBreaker("test", failures=2, cooldown=cooldown)
+    for _ in range(2):
+        breaker.before_call(); breaker.record_failure()
+    return breaker
+
+def test_opens_after_consecutive_failures():
+    breaker = CircuitBreaker("test", failures=2, cooldown=60)
+    breaker.before_call(); breaker.record_failure()
+    assert breaker.state == "closed"
+    breaker.before_call(); breaker.record_failure()
+    assert breaker.state == "open"
+    with pytest.raises(CircuitOpen): breaker.before_call()
+
+def test_success_resets_the_failure_count():
+    breaker = CircuitBreaker("test", failures=2, cooldown=60)
+    breaker.before_call(); breaker.record_failure()
+    breaker.before_call(); breaker.record_success()
+    breaker.before_call(); breaker.record_failure()
+    assert breaker.state == "closed"
+
+def test_half_open_lets_one_probe_through():
+    breaker = open_breaker(cooldown=0)
+    breaker.before_call()
+    assert breaker.state == "half_open"
+    with pytest.raises(CircuitOpen): breaker.before_call()
+    breaker.record_success()
+    assert breaker.state == "closed"
+    breaker.before_call()
+
+def test_failed_probe_reopens():
+    breaker = open_breaker(cooldown=0.05)
+    time.sleep(0.06); breaker.before_call(); breaker.record_failure()
+    assert breaker.state == "open"
+    with pytest.raises(CircuitOpen): breaker.before_call()
+
+def test_abandoned_probe_allows_another():
+    breaker = open_breaker(cooldown=0)
+    breaker.before_call(); breaker.record_abandoned()
+    breaker.before_call()
+    assert breaker.state == "half_open" and breaker.probing
+
+def test_disabled_breaker_never_opens():
+    breaker = CircuitBreaker("test", failures=0, cooldown=60)
+    for _ in range(10):
+        breaker.before_call(); breaker.record_failure()
+    breaker.before_call()
+
+def test_probe_refused_by_quota_does_not_stick(monkeypatch):
+    breaker = open_breaker(cooldown=0)
+    monkeypatch.setattr(dgis, "breaker", breaker)
+    async def refuse(*args, **kwargs): raise QuotaExceeded("no tokens")
+    monkeypatch.setattr(dgis, "acquire", refuse)
+    for _ in range(3):
+        with pytest.raises(QuotaExceeded): asyncio.run(dgis._get_json("/items", {}, "dgis_page"))
+    assert breaker.state == "half_open" and not breaker.probing
+
+def test_probe_cancelled_while_waiting_for_quota_does_not_stick(monkeypatch):
+    breaker = open_breaker(cooldown=0)
+    monkeypatch.setattr(dgis, "breaker", breaker)
+    async def wait_forever(*args, **kwargs): await asyncio.sleep(60)
+    monkeypatch.setattr(dgis, "acquire", wait_forever)
+    async def cancel_probe():
+        task = asyncio.ensure_future(dgis._get_json("/items", {}, "dgis_page"))
+        await asyncio.sleep(0.01); task.cancel()
+        with pytest.raises(asyncio.CancelledError): await task
+    asyncio.run(cancel_probe())
+    assert not breaker.probing
@@ -0,0 +1,62 @@
+import sys
+import asyncio
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import caches
+import dgis
+import nearby
+import persistence
+import quota
+import warmup
+from bench.fake_services import fake_dgis
+from http_client import close_http_clients
+
+# Two users in the same tile with different radii, and one far away.
+USERS = {1: (43.2381, 76.9452, 1.0), 2: (43.2383, 76.9455, 2.0), 3: (51.128, 71.43, 1.0)}
+
+@pytest.fixture
+def redis(monkeypatch):
+    import fakeredis
+    client = fakeredis.FakeAsyncRedis()
+    for module in (persistence, caches, quota, nearby, warmup): monkeypatch.setattr(module, "get_async_redis", lambda: client)
+    monkeypatch.setattr(dgis, "DGIS_SAMPLING", "nearby")
+    monkeypatch.setattr(dgis, "breaker", dgis.CircuitBreaker("test", 0, 0))
+    monkeypatch.setattr(quota, "DGIS_RATE_LIMIT", 0)
+    nearby._index_lru.clear()
+    async def save():
+        for user_id, (lat, lon, radius_km) in USERS.items():
+            await client.hset(f"user:{user_id}", mapping=persistence.encode_user_fields({"last_coords": [lat, lon], "radius_km": radius_km}))
+    asyncio.run(save())
+    yield client
+    nearby._index_lru.clear()
+
+def warm_then_search(service, monkeypatch) -> tuple[dict, int]:
+    """Runs the warm-up, then every user's search; returns the report and the searches' 2GIS requests."""
+    monkeypatch.setattr(dgis, "DGIS_BASE_URL", f"{service.url}/3.0")
+    async def run():
+        try:
+            report = await warmup.warm_up(top=10, concurrency=2, budget=0)
+            before = service.request_count
+            for lat, lon, radius_km in USERS.values(): assert await dgis.get_random_lunch_place(lat, lon, int(radius_km * 1000))
+            return report, service.request_count - before
+        finally:
+            await close_http_clients()
+    return asyncio.run(run())
+
+def test_sparse_area_warms_the_nearby_indexes(redis, monkeypatch):
+    with fake_dgis(total_places=40) as service:
+        report, search_requests = warm_then_search(service, monkeypatch)
+    assert {row["kind"] for row in report["rows"]} == {"nearby"} and report["covered"] == 3
+    assert search_requests == 0
+
+def test_dense_area_warms_the_page_buckets_searches_read(redis, monkeypatch):
+    with fake_dgis(total_places=500) as service:
+        report, search_requests = warm_then_search(service, monkeypatch)
+    pages = [row for row in report["rows"] if row["kind"] == "pages"]
+    assert sorted(row["radius_m"] for row in pages) == [1000, 1000, 2000]
+    assert all(row["status"] == "warmed" for row in report["rows"]) and report["covered"] == 3
+    assert search_requests == 0
@@ -0,0 +1,39 @@
+import sys
+import asyncio
+from pathlib import Path
+from contextlib import asynccontextmanager
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from telegram import Update
+
+import worker
+
+def message(update_id: int, user_id: int) -> Update:
+    return Update.de_json({"update_id": update_id, "message": {"message_id": update_id, "date": 0, "text": "hi",
+                           "chat": {"id": user_id, "type": "private"}, "from": {"id": user_id, "is_bot": False, "first_name": "u"}}}, None)
+
+def test_one_users_updates_run_in_order_even_if_claims_finish_out_of_order(monkeypatch):
+    handled = []
+    async def slow_first_claim(updates):
+        await asyncio.sleep(0.05 if updates[0].update_id == 1 else 0); return updates
+    @asynccontextmanager
+    async def scope(application, update, locked=False):
+        assert locked; yield
+    monkeypatch.setattr(worker, "claim_updates", slow_first_claim)
+    monkeypatch.setattr(worker, "update_scope", scope)
+    async def handle(update_id):
+        handled.append(update_id)
+    async def run():
+        processor = worker.SessionUpdateProcessor(8)
+        await asyncio.gather(*(processor.do_process_update(message(update_id, 7), handle(update_id)) for update_id in (1, 2, 3)))
+    asyncio.run(run())
+    assert handled == [1, 2, 3]
+
+def test_redelivered_update_is_dropped(monkeypatch):
+    async def already_claimed(updates): return []
+    monkeypatch.setattr(worker, "claim_updates", already_claimed)
+    handled = []
+    async def handle(): handled.append(1)
+    asyncio.run(worker.SessionUpdateProcessor(8).do_process_update(message(1, 7), handle()))
+    assert handled == []
@@ -0,0 +1,150 @@
+# warmup.py
+"""Pre-lunch cache warm-up.
+
+Reads every user's saved location from Redis, groups users by the cache bucket their next
+search will hit, and fetches the most popular buckets ahead of the noon peak. Schedule it a
+few minutes before the peak, e.g. from cron:
+
+    45 11 * * 1-5  python warmup.py --top 50 --budget 300
+"""
+import os
+import json
+import asyncio
+import logging
+import argparse
+from collections import Counter
+
+import dgis
+import metrics
+from caches import MISS, snap_to_tile, place_cache_key, get_cached_page
+from nearby import NEARBY_RADIUS, nearby_tile, get_cached_index
+from persistence import get_async_redis, FIELD_CODECS
+from resilience import deadline
+
+logger = logging.getLogger(__name__)
+DEFAULT_RADIUS_KM = 1.0
+WARMUP_TOP = int(os.getenv("WARMUP_TOP", "50"))
+WARMUP_CONCURRENCY = int(os.getenv("WARMUP_CONCURRENCY", "4"))
+# At most this many 2GIS requests per run (0: no limit besides the shared rate limit).
+WARMUP_BUDGET = int(os.getenv("WARMUP_BUDGET", "300"))
+SCAN_BATCH = 500
+
+async def scan_user_locations() -> list[tuple[float, float, float]]:
+    """(lat, lon, radius_km) of every user with saved coordinates, one pipelined round-trip per SCAN batch."""
+    client = get_async_redis()
+    if client is None: return []
+    locations = []; cursor = 0
+    decode_coords, decode_radius = FIELD_CODECS["last_coords"][1], FIELD_CODECS["radius_km"][1]
+    while True:
+        cursor, keys = await client.scan(cursor, match="user:*", count=SCAN_BATCH)
+        if keys:
+            pipe = client.pipeline(transaction=False)
+            for key in keys: pipe.hmget(key, "last_coords", "radius_km")
+            rows = await pipe.execute(raise_on_error=False)
+            # Keys not yet migrated to hashes fail with WRONGTYPE; read those as JSON in one MGET.
+            legacy = [key for key, row in zip(keys, rows) if isinstance(row, Exception)]
+            for row in rows:
+                if isinstance(row, Exception) or not row[0]: continue
+                lat, lon = decode_coords(row[0]); locations.append((lat, lon, decode_radius(row[1]) if row[1] else DEFAULT_RADIUS_KM))
+            for data in (await client.mget(legacy) if legacy else []):
+                user_data = json.loads(data) if data else {}
+                if user_data.get("last_coords"):
+                    lat, lon = user_data["last_coords"]; locations.append((lat, lon, float(user_data.get("radius_km", DEFAULT_RADIUS_KM))))
+        if cursor == 0: return locations
+
+def bucket_of(lat: float, lon: float, radius_km: float, indexes: dict) -> tuple:
+    """The cache bucket a search from this location reads, decided like dgis._covering_index: the
+    nearby tile while its index is unbuilt or covers the radius, else the page-cache tile and radius.
+    `indexes` maps nearby tile keys to their cached index (or MISS)."""
+    radius_meters = int(radius_km * 1000)
+    if dgis.DGIS_SAMPLING == "nearby" and radius_meters <= NEARBY_RADIUS:
+        tile_lat, tile_lon, key = nearby_tile(lat, lon); index = indexes.get(key, MISS)
+        if index is MISS or index.covers(lat, lon, radius_meters): return "nearby", tile_lat, tile_lon, NEARBY_RADIUS
+    return ("pages", *snap_to_tile(lat, lon, radius_meters))
+
+async def cached_indexes(locations: list[tuple[float, float, float]]) -> dict:
+    if dgis.DGIS_SAMPLING != "nearby": return {}
+    return {key: await get_cached_index(key) for key in {nearby_tile(lat, lon)[2] for lat, lon, _ in locations}}
+
+async def cached_places(bucket: tuple) -> int | None:
+    """How many places the cache already holds for the bucket (for pages, 2GIS's total), or None if it is cold."""
+    kind, lat, lon, radius_meters = bucket
+    if kind == "nearby":
+        index = await get_cached_index(nearby_tile(lat, lon)[2])
+        return None if index is MISS else len(index)
+    page = await get_cached_page(place_cache_key(lat, lon, radius_meters, 1))
+    return None if page is None else (page[1] or len(page[0]))
+
+async def warm_bucket(bucket: tuple) -> int:
+    """Fills the cache for one bucket. Returns the number of places found."""
+    kind, lat, lon, radius_meters = bucket
+    if kind == "nearby":
+        index = await dgis.get_nearby_index(lat, lon)
+        return len(index) if index is not None else 0
+    with deadline(dgis.DGIS_SEARCH_TIMEOUT): return len(await dgis.fetch_all_places(lat, lon, radius_meters))
+
+def _requests_made() -> float:
+    # Every 2GIS call, whatever its outcome; pages_fetched would miss failed and timed-out ones.
+    return metrics.total("lunchbot_dgis_requests_total")
+
+async def warm_up(top: int = WARMUP_TOP, concurrency: int = WARMUP_CONCURRENCY, budget: int = WARMUP_BUDGET) -> dict:
+    """Warms the `top` most popular buckets. Returns the report: one row per bucket, most users first."""
+    locations = await scan_user_locations()
+    semaphore = asyncio.Semaphore(max(1, concurrency)); started = _requests_made()
+    async def warm(bucket: tuple, users: int) -> dict:
+        row = {"kind": bucket[0], "lat": bucket[1], "lon": bucket[2], "radius_m": bucket[3], "users": users, "places": 0}
+        async with semaphore:
+            cached = await cached_places(bucket)
+            if cached is not None: return {**row, "places": cached, "status": "cached"}
+            # Buckets already in flight may overshoot the budget by a few requests.
+            if budget and _requests_made() - started >= budget: return {**row, "status": "skipped"}
+            try:
+                row["places"] = await warm_bucket(bucket)
+            except Exception as e:
+                logger.error(f"Warming {bucket} failed: {e}"); return {**row, "status": "failed"}
+            if not row["places"]: return {**row, "status": "empty"}
+            # Failed or cut-off pages leave an index uncached, or fewer places than 2GIS reported.
+            cached = await cached_places(bucket)
+            complete = cached is not None and row["places"] >= min(cached, dgis.PAGE_SIZE * dgis.MAX_PAGES)
+            return {**row, "status": "warmed" if complete else "partial"}
+    # Whether a nearby index covers a user's radius is only known once it is built, so a second
+    # round warms the page buckets of users in dense areas, where searches go to 2GIS directly.
+    rows = []; attempted = set()
+    for _ in range(2):
+        indexes = await cached_indexes(locations)
+        buckets = Counter(bucket_of(*location, indexes) for location in locations)
+        todo = [(bucket, users) for bucket, users in buckets.most_common() if bucket not in attempted and (not rows or bucket[0] == "pages")][:top]
+        if not todo: break
+        attempted.update(bucket for bucket, _ in todo)
+        rows += await asyncio.gather(*(warm(bucket, users) for bucket, users in todo))
+    ready = {(row["kind"], row["lat"], row["lon"], row["radius_m"]) for row in rows if row["status"] in ("warmed", "cached")}
+    covered = sum(users for bucket, users in buckets.items() if bucket in ready)
+    return {"users": len(locations), "covered": covered, "buckets": len(buckets), "requests": int(_requests_made() - started), "rows": rows}
+
+def format_report(report: dict) -> str:
+    lines = [f"{'bucket':<24}{'kind':>7}{'radius':>8}{'users':>7}{'places':>8}  status"]
+    for row in report["rows"]:
+        lines.append(f"{row['lat']:.6f},{row['lon']:.6f}".ljust(24) + f"{row['kind']:>7}{row['radius_m']:>8}{row['users']:>7}{row['places']:>8}  {row['status']}")
+    ready = [row for row in report["rows"] if row["status"] in ("warmed", "cached")]
+    lines.append(f"\n{report['covered']} of {report['users']} users covered by {len(ready)} of {report['buckets']} buckets; {report['requests']} 2GIS requests")
+    return "\n".join(lines)
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--top", type=int, default=WARMUP_TOP, help="how many of the most popular buckets to warm")
+    parser.add_argument("--concurrency", type=int, default=WARMUP_CONCURRENCY, help="buckets warmed at once")
+    parser.add_argument("--budget", type=int, default=WARMUP_BUDGET, help="stop starting buckets after this many 2GIS requests (0: no limit)")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    if get_async_redis() is None: raise SystemExit("KV_URL is not set; there is nothing to read users from or warm.")
+    try:
+        report = await warm_up(args.top, args.concurrency, args.budget)
+        print(json.dumps(report, ensure_ascii=False) if args.json else format_report(report))
+    finally:
+        from http_client import close_http_clients
+        from persistence import close_async_redis
+        await close_http_clients(); await close_async_redis()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,92 @@
+# worker.py
+import os
+import logging
+import threading
+from contextlib import nullcontext
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from telegram import Update
+from telegram.ext import Application, BaseUpdateProcessor
+
+import metrics
+from bot_logic import add_handlers, TimedRequest
+from dispatcher import claim_updates, finish_update, update_scope, user_lock
+from persistence import close_async_redis
+from http_client import close_http_clients
+
+# --- Long-running polling worker ---
+# The self-hosted alternative to the webhook: one Application for the life of the process,
+# fetching updates with getUpdates and handling up to WORKER_CONCURRENCY of them at once.
+# Caches, the Redis pool and the HTTP clients stay warm between updates. Run: python worker.py
+logger = logging.getLogger(__name__)
+BOT_TOKEN = os.getenv("TELEGRAM_TOKEN")
+TELEGRAM_BASE_URL = os.getenv("TELEGRAM_BASE_URL", "https://api.telegram.org/bot")
+WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", "32"))
+WORKER_POLL_TIMEOUT = int(os.getenv("WORKER_POLL_TIMEOUT", "30"))
+# Serve /metrics on this port (0 disables it).
+WORKER_METRICS_PORT = int(os.getenv("WORKER_METRICS_PORT", "0"))
+
+class SessionUpdateProcessor(BaseUpdateProcessor):
+    """Runs updates concurrently, each inside the same timings, user lock and session as the webhook."""
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates); self.application: Application | None = None
+
+    async def initialize(self) -> None: pass
+
+    async def shutdown(self) -> None: pass
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        if not isinstance(update, Update):
+            await coroutine; return
+        user = update.effective_user
+        # Updates are started in update_id order and the user's lock queues its waiters FIFO, so
+        # the lock must be the first thing awaited: a Redis claim before it could reorder them.
+        async with user_lock(user.id) if user else nullcontext():
+            if not await claim_updates([update]):
+                # Already handled, e.g. by a previous run that crashed before confirming the offset.
+                coroutine.close(); return
+            try:
+                async with update_scope(self.application, update, locked=True): await coroutine
+            except BaseException:
+                await finish_update(update, done=False); raise
+            await finish_update(update, done=True)
+
+async def post_shutdown(application: Application) -> None:
+    await close_async_redis()
+    await close_http_clients()
+
+def build_application() -> Application:
+    processor = SessionUpdateProcessor(WORKER_CONCURRENCY)
+    application = (Application.builder().token(BOT_TOKEN).base_url(TELEGRAM_BASE_URL)
+                   .request(TimedRequest(connection_pool_size=max(WORKER_CONCURRENCY * 2, 8)))
+                   .concurrent_updates(processor).post_shutdown(post_shutdown).build())
+    processor.application = application
+    add_handlers(application)
+    return application
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404); return
+        body = metrics.render().encode()
+        self.send_response(200); self.send_header("Content-Type", "text/plain; version=0.0.4"); self.send_header("Content-Length", str(len(body))); self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args): pass
+
+def serve_metrics(port: int) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer(("0.0.0.0", port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
+
+def main() -> None:
+    logging.basicConfig(format="%(asctime)s %(name)s %(levelname)s %(message)s", level=logging.INFO)
+    # httpx logs every long poll at INFO.
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    if not BOT_TOKEN: raise SystemExit("TELEGRAM_TOKEN is not set")
+    if WORKER_METRICS_PORT: serve_metrics(WORKER_METRICS_PORT)
+    logger.info(f"Polling with up to {WORKER_CONCURRENCY} concurrent updates")
+    # SIGINT/SIGTERM stop polling, let in-flight updates finish, then run post_shutdown.
+    build_application().run_polling(allowed_updates=Update.ALL_TYPES, timeout=WORKER_POLL_TIMEOUT)
+
+if __name__ == "__main__":
+    main()